@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
+import os
 import re
 from datetime import datetime
 from enum import Enum
-from itertools import zip_longest
-from os.path import getmtime
+from itertools import groupby, islice, product, zip_longest
 
 
 class SequenceType(Enum):
@@ -12,32 +12,61 @@ class SequenceType(Enum):
     SEQ = 2
     MDATE = 3
     MTIME = 4
+    SIZE = 5
+    CDATE = 6
+    CTIME = 7
+    INODE = 8
+    OWNER = 9
+
+
+# rules that read the file's stat result
+METADATA = {SequenceType.MDATE, SequenceType.MTIME, SequenceType.SIZE, SequenceType.CDATE,
+            SequenceType.CTIME, SequenceType.INODE, SequenceType.OWNER}
 
 
 class StringSequence:
     def __init__(self, args):
         self.rules = []
         self.curdir = None
+        self.dir_index = -1
+        self.index = 0
+        self.values = {}
+        self.cache = None
+        self.owners = {}
         self.args = args
         self._parse_args(args)
 
     def __call__(self, filepath, dirpath, filename):
-        if self.curdir is None:
+        if self.curdir != dirpath:
+            # sequences restart in each directory
             self.curdir = dirpath
+            self.dir_index += 1
+            self.index = 0
+        else:
+            self.index += 1
+        return self.at(self.dir_index, self.index, filepath, filename)
+
+    def at(self, dir_index, file_index, filepath, filename):
+        """Return the sequence for the file_index'th file in a row of
+        the dir_index'th directory. Doesn't change any state, so files
+        can be done in any order, e.g. by several processes.
+        """
         st = ""
-        for t, r in self.rules:
+        stat = None
+        for n, (t, r) in enumerate(self.rules):
             if t == SequenceType.SEQ:
-                if self.curdir != dirpath:
-                    self.curdir = dirpath
-                    st += r.send("reset")
+                values = self.values.get(n)
+                if values is not None and file_index < len(values):
+                    st += values[file_index]
                 else:
-                    st += next(r)
+                    st += r.value_at(dir_index, file_index)
             elif t == SequenceType.FILE:
                 st += filename
-            elif t == SequenceType.MDATE:
-                st += r(filepath)
-            elif t == SequenceType.MTIME:
-                st += r(filepath)
+            elif t in METADATA:
+                # stat once, shared by every metadata rule
+                if stat is None:
+                    stat = self._stat(filepath)
+                st += r(stat)
             elif t == SequenceType.RAW:
                 st += r
         return st
@@ -51,86 +80,66 @@ class StringSequence:
     def get_rules(self):
         return self.rules
 
-    def _num_generator(self, depth=2, start=1, end=None, step=1):
-        """Generator function for numbers given a depth, start, end, step\n
-        Resets are supported. If reset, go back to start.\n
-        If end > start, or step = 0 values will always be start.
-        """
-        start = start if start is not None else 1
-        step = step if step is not None else 1
-        i = start
-        while True:
-            ret = "{:0{depth}d}".format(i, depth=depth)
-            val = yield ret
-            if val == "reset":
-                i = start
-            else:
-                i += step
-                if end and i > end:
-                    i = start
-
-    def _alpha_generator(self, depth=1, start="a", end=None):
-        """Generator function for letters given a depth, start, end.\n
-        Start is where sequencing begins. Consists only of letters.\n
-        End is where sequencing ends. Consists only of letters.\n
-        Depth determines how much end should repeat.\n
-        Lowercase increments to uppercase, but NOT vice-versa.
+    def prepare(self, files):
+        """Compute sequence values for files with one call per rule.\n
+        Sequences restart in each directory, so every directory takes
+        values from the start of the same list, sized for the most
+        files found in a row in one directory. The size is only a hint,
+        values past it are computed with value_at.
         """
-        # convert start, end into list of chars
-        start = list(start) if start is not None else ["a"]
-        f = lambda x: "z" if x.islower() else "Z"
-        end = depth * list(end) if end is not None else depth * list(map(f, start))
+        dirs = [path[:path.rfind(os.sep) + 1] for path in files]
+        longest = max((sum(1 for _ in run) for _, run in groupby(dirs)), default=0)
+        for n, (t, r) in enumerate(self.rules):
+            if t == SequenceType.SEQ:
+                self.values[n] = r.batch(longest)
+        self.curdir = None
+        self.dir_index = -1
+        self.index = 0
 
-        if len(start) < len(end):
-            # fill start with starting char a
-            # a:zzz --> aaa:zzz
-            start, end = zip_longest(*zip_longest(start, end, fillvalue="a"))
-        elif len(start) > len(end):
-            # fill end with None
-            # aaa:z --> aaa:z--
-            start, end = zip_longest(*zip_longest(start, end))
+    def set_cache(self, cache):
+        """Look up file stats in a scanner.DirCache """
+        self.cache = cache
 
-        def do_increment(ch, start_ch, end_ch):
-            """Perform character increment depending on start/end character.\n
-            if (a - Z) increment until z, then switch to uppercase
-                and reset when = end
-            otherwise just increment.\n
-            if (A - z) don't increment.\n
-            if (a - None) don't increment.\n
-            if (A - None) don't increment.
-            """
-            if start_ch.islower() and end_ch.isupper():
-                if ch.islower():
-                    return chr(ord(ch) + 1) if ch != "z" else "A"
-            elif start_ch.isupper() and end_ch.islower():
-                return ch
-            return chr(ord(ch) + 1) if ch < end_ch else start_ch
-
-        st = list(start)
-        while True:
-            val = yield "".join(st)
-            if val == "reset":
-                st = list(start)
-            else:
-                for count, item in reversed(list(enumerate(st))):
-                    start_ch, end_ch = start[count], end[count]
-                    if end_ch:
-                        tmp = do_increment(item, start_ch, end_ch)
-                        if st[count] != tmp:
-                            # stop incrementing list if we've incremented something
-                            st[count] = tmp
-                            if tmp != start_ch:
-                                break
-
-    def _md_generator(self, arg):
+    def _stat(self, path):
+        if self.cache is not None:
+            return self.cache.stat(path)
+        return os.stat(path)
+
+    def _md_generator(self, stat):
         """Return modification date of file """
-        tstamp = getmtime(arg)
-        return datetime.fromtimestamp(tstamp).strftime("%Y-%m-%d")
+        return datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d")
 
-    def _mt_generator(self, arg):
+    def _mt_generator(self, stat):
         """Return modification time of file """
-        tstamp = getmtime(arg)
-        return datetime.fromtimestamp(tstamp).strftime("%H.%M.%S")
+        return datetime.fromtimestamp(stat.st_mtime).strftime("%H.%M.%S")
+
+    def _cd_generator(self, stat):
+        """Return ctime date of file (metadata change on Unix, creation on Windows) """
+        return datetime.fromtimestamp(stat.st_ctime).strftime("%Y-%m-%d")
+
+    def _ct_generator(self, stat):
+        """Return ctime time of file (metadata change on Unix, creation on Windows) """
+        return datetime.fromtimestamp(stat.st_ctime).strftime("%H.%M.%S")
+
+    def _sz_generator(self, stat):
+        """Return size of file in bytes """
+        return str(stat.st_size)
+
+    def _in_generator(self, stat):
+        """Return inode number of file """
+        return str(stat.st_ino)
+
+    def _ow_generator(self, stat):
+        """Return name of file owner, or user id if it has no name """
+        name = self.owners.get(stat.st_uid)
+        if name is None:
+            try:
+                import pwd
+                name = pwd.getpwuid(stat.st_uid).pw_name
+            except (ImportError, KeyError):
+                name = str(stat.st_uid)
+            self.owners[stat.st_uid] = name
+        return name
 
     def _parse_num(self, args):
         """Parse the arguments as a number sequence.\n
@@ -158,8 +167,7 @@ class StringSequence:
         if any(n and n < 0 for n in sl):
             # check for negative numbers, skip None values
             raise ValueError(msg3)
-        gen = self._num_generator(depth, *sl)
-        self.rules.append((SequenceType.SEQ, gen))
+        self.rules.append((SequenceType.SEQ, NumSequence(depth, *sl)))
 
     def _parse_alpha(self, args):
         """Parse the arguments as an alphabetical sequence.\n
@@ -187,8 +195,7 @@ class StringSequence:
                 if not re.match("^[a-zA-Z]+$", x):
                     raise ValueError(msg3)
                 sl.append(x)
-        gen = self._alpha_generator(depth, *sl)
-        self.rules.append((SequenceType.SEQ, gen))
+        self.rules.append((SequenceType.SEQ, AlphaSequence(depth, *sl)))
 
     def _parse_seq(self, arg):
         # %a[depth]:start:end or
@@ -221,17 +228,152 @@ class StringSequence:
                 self.rules.append((SequenceType.MDATE, self._md_generator))
             elif n == "%mt":
                 self.rules.append((SequenceType.MTIME, self._mt_generator))
+            elif n == "%cd":
+                self.rules.append((SequenceType.CDATE, self._cd_generator))
+            elif n == "%ct":
+                self.rules.append((SequenceType.CTIME, self._ct_generator))
+            elif n == "%sz":
+                self.rules.append((SequenceType.SIZE, self._sz_generator))
+            elif n == "%in":
+                self.rules.append((SequenceType.INODE, self._in_generator))
+            elif n == "%ow":
+                self.rules.append((SequenceType.OWNER, self._ow_generator))
             elif n == "%n":
                 # create a default num sequence
-                numgen = self._num_generator()
-                self.rules.append((SequenceType.SEQ, numgen))
+                self.rules.append((SequenceType.SEQ, NumSequence()))
             elif n == "%a":
                 # create a default alphabetical sequence
-                alphagen = self._alpha_generator()
-                self.rules.append((SequenceType.SEQ, alphagen))
+                self.rules.append((SequenceType.SEQ, AlphaSequence()))
             elif n[0] != "%":
                 # add raw string
                 self.rules.append((SequenceType.RAW, n))
             else:
                 # this is a sequence with arguments, parse it
                 self._parse_seq(n)
+
+
+class NumSequence:
+    """Number sequence given a depth, start, end, step.\n
+    Values go from start by step and go back to start once past end.
+    If end < start, or step = 0 values will always be start.
+    """
+    def __init__(self, depth=2, start=1, end=None, step=1):
+        self.start = start if start is not None else 1
+        self.step = step if step is not None else 1
+        self.fmt = "{{:0{}d}}".format(depth).format
+        # number of values before going back to start, None if never
+        self.period = None
+        if not self.step or end and end < self.start:
+            self.period = 1
+        elif end:
+            self.period = (end - self.start) // self.step + 1
+
+    def value_at(self, dir_index, file_index):
+        """Return value of the file_index'th file in a directory.\n
+        Sequences restart in each directory, so dir_index is unused.
+        """
+        if self.period is not None:
+            file_index %= self.period
+        return self.fmt(self.start + file_index * self.step)
+
+    def batch(self, count):
+        """Return the first count values """
+        size = count if self.period is None else min(count, self.period)
+        values = [self.fmt(self.start + i * self.step) for i in range(size)]
+        return _repeat(values, count)
+
+
+class AlphaSequence:
+    """Alphabetical sequence given a depth, start, end.\n
+    Start is where sequencing begins. Consists only of letters.\n
+    End is where sequencing ends. Consists only of letters.\n
+    Depth determines how much end should repeat.\n
+    Lowercase increments to uppercase, but NOT vice-versa.\n
+    Each letter runs through its own range and carries into the
+    letter on its left, so values are indexed like a number
+    with one base per letter.
+    """
+    def __init__(self, depth=1, start="a", end=None):
+        # convert start, end into list of chars
+        start = list(start) if start is not None else ["a"]
+        f = lambda x: "z" if x.islower() else "Z"
+        end = depth * list(end) if end is not None else depth * list(map(f, start))
+
+        if len(start) < len(end):
+            # fill start with starting char a
+            # a:zzz --> aaa:zzz
+            start, end = zip_longest(*zip_longest(start, end, fillvalue="a"))
+        elif len(start) > len(end):
+            # fill end with None
+            # aaa:z --> aaa:z--
+            start, end = zip_longest(*zip_longest(start, end))
+
+        self.letters = [_alpha_range(start_ch, end_ch) for start_ch, end_ch in zip(start, end)]
+        self.period = 1
+        for letters in self.letters:
+            self.period *= len(letters)
+
+    def value_at(self, dir_index, file_index):
+        """Return value of the file_index'th file in a directory.\n
+        Sequences restart in each directory, so dir_index is unused.
+        """
+        file_index %= self.period
+        st = []
+        for letters in reversed(self.letters):
+            file_index, i = divmod(file_index, len(letters))
+            st.append(letters[i])
+        return "".join(reversed(st))
+
+    def batch(self, count):
+        """Return the first count values """
+        values = list(map("".join, islice(product(*self.letters), count)))
+        return _repeat(values, count)
+
+
+def positions(files):
+    """Return (dir_index, file_index) of each file for StringSequence.at.\n
+    A directory is counted again each time files go back to it.
+    """
+    res = []
+    curdir = None
+    dir_index = file_index = -1
+    for path in files:
+        dirpath = os.path.split(path)[0]
+        if dirpath != curdir:
+            curdir = dirpath
+            dir_index += 1
+            file_index = 0
+        else:
+            file_index += 1
+        res.append((dir_index, file_index))
+    return res
+
+
+def _repeat(values, count):
+    """Repeat values to a list of count values """
+    if not values:
+        return values
+    reps, rest = divmod(count, len(values))
+    return values * reps + values[:rest]
+
+
+def _alpha_range(start_ch, end_ch):
+    """Return the letters a sequence letter goes through before it
+    goes back to start_ch, e.g. ('a', 'Z') -> 'a...zA...Z'.\n
+    if (a - Z) increment until z, then switch to uppercase.\n
+    if (A - z) don't increment.\n
+    if (a - None) don't increment.\n
+    if (A - None) don't increment.
+    """
+    if not end_ch or (start_ch.isupper() and end_ch.islower()):
+        return start_ch
+    letters = [start_ch]
+    ch = start_ch
+    while True:
+        if start_ch.islower() and end_ch.isupper() and ch.islower():
+            ch = chr(ord(ch) + 1) if ch != "z" else "A"
+        elif ch < end_ch:
+            ch = chr(ord(ch) + 1)
+        else:
+            return "".join(letters)
+        letters.append(ch)
@@ -1,25 +1,32 @@
 #!/usr/bin/env python3
 import argparse
-import glob
 import os
 import re
 import sre_constants
+import sys
 import textwrap
-
-from natsort import natsorted, ns
+from functools import partial
 
 from batchren import _version
-from batchren import helper, renamer, StringSeq
-from batchren.tui import arrange_tui, selection_tui
+from batchren import helper, journal, plan, renamer, scanner, StringSeq
+from batchren.cache import PlanCache
 
 
-def glob_files(pattern):
-    files = [f for f in glob.iglob(pattern, recursive=True) if os.path.isfile(f)]
-    return natsorted(files, reverse=False, alg=ns.PATH)
+def glob_files(pattern, jobs=1, sortkeys=None, cache=None):
+    """Return files matching pattern in natural order.\n
+    Sort keys are stored in sortkeys to be reused by later sorts.
+    Directory listings are stored in cache if given.
+    """
+    if sortkeys is None:
+        sortkeys = helper.SortKeys()
+    files = scanner.scan_files(pattern, jobs, cache)
+    return sortkeys.sort(files)
 
 
 def check_optional(args):
-    notfilter = {"dryrun", "quiet", "verbose", "path", "sort", "sel", "esc", "raw"}
+    notfilter = {"dryrun", "quiet", "verbose", "path", "sort", "sel", "esc", "raw",
+                 "jobs", "procs", "parallel_renames", "journal", "recover",
+                 "summary", "stream", "plan_out", "plan_in", "cache", "preview"}
     argdict = vars(args)
 
     for argname, argval in argdict.items():
@@ -64,6 +71,20 @@ def validate_esc(esc):
     return "".join(argset)
 
 
+def validate_jobs(jobs):
+    """Validate jobs, procs, parallel renames and summary options\n
+    Give an error if argument is not a positive integer
+    """
+    err = "value must be a positive integer"
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        raise argparse.ArgumentTypeError(err)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(err)
+    return jobs
+
+
 def trim(arg):
     return arg.strip()
 
@@ -162,6 +183,7 @@ class RegexAction(argparse.Action):
     If two arguments, replace all instances PATTERN by REPL.\n
     If three arguments, replace COUNT'th instance of PATTERN BY REPL.\n
     Second argument default is '', third argument default is 0.\n
+    Can be given more than once, regexes are applied in order.\n
     Give an error if:\n
     -   pattern argument is empty
     -   no arguments/too many arguments (>3)
@@ -195,7 +217,7 @@ class RegexAction(argparse.Action):
         except ValueError:
             # error from converting count into int
             parser.error(argtype + err3)
-        namespace.regex = (regexp, val, count)
+        namespace.regex = (namespace.regex or []) + [(regexp, val, count)]
 
 
 class BracketAction(argparse.Action):
@@ -258,6 +280,30 @@ class SequenceAction(argparse.Action):
             namespace.sequence = seq
 
 
+class RecoverAction(argparse.Action):
+    """batchren --recover JOURNAL [forward|rollback]\n
+    Custom action for recover. Accept up to two arguments.\n
+    Return argument as a tuple of journal and mode (default: forward).\n
+    Give an error if:\n
+    -   no arguments/too many arguments (>2)
+    -   journal file doesn't exist
+    -   mode isn't forward or rollback
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        argtype = "argument --recover: "
+        err0 = "expected up to two arguments"
+        err1 = "journal file not found: "
+        err2 = "mode must be forward or rollback"
+        if len(values) > 2:
+            parser.error(argtype + err0)
+        if not os.path.isfile(values[0]):
+            parser.error(argtype + err1 + values[0])
+        mode = values[1] if len(values) == 2 else "forward"
+        if mode not in ("forward", "rollback"):
+            parser.error(argtype + err2)
+        namespace.recover = (values[0], mode)
+
+
 class CustomFormatter(argparse.RawTextHelpFormatter):
     """Custom formatter for argparse.\n
     Skip long optionals that have parameters.\n
@@ -272,6 +318,8 @@ class CustomFormatter(argparse.RawTextHelpFormatter):
             return "PATTERN [REPL] [COUNT]"
         elif option_string == "--bracket_remove":
             return "{arsc} [COUNT]"
+        elif option_string == "--recover":
+            return "JOURNAL [forward|rollback]"
         else:
             return args_string
 
@@ -283,7 +331,9 @@ class CustomFormatter(argparse.RawTextHelpFormatter):
 
         else:
             parts = []
-            long_options = ["--sort", "--esc", "--raw"]
+            long_options = ["--sort", "--esc", "--raw", "--jobs", "--procs", "--parallel-renames",
+                            "--journal", "--recover", "--summary", "--stream",
+                            "--plan-out", "--plan-in", "--cache", "--preview"]
             if action.nargs == 0:
                 # if the optional doesn't take a value, format is:
                 #    -s, --long
@@ -352,7 +402,7 @@ parser.add_argument("-sh", "--shave", type=trim, action=ShaveAction,
 parser.add_argument("-bracr", "--bracket_remove", nargs="*", type=trim, action=BracketAction,
                     help="remove bracket type and its contents")
 parser.add_argument("-re", "--regex", nargs="*", action=RegexAction,
-                    help="specify pattern to remove/replace")
+                    help="specify pattern to remove/replace, can be repeated")
 parser.add_argument("-pre", "--prepend", metavar="STR",
                     help="prepend string to filename")
 parser.add_argument("-post", "--postpend", metavar="STR",
@@ -369,6 +419,28 @@ parser.add_argument("--sort", choices=["asc", "desc", "man"], default="asc",
                     help="rename files found in specific order")
 parser.add_argument("--sel", action="store_true",
                     help="manually select files from pattern match")
+parser.add_argument("--preview", action="store_true",
+                    help="show new names next to files in --sel and --sort man")
+parser.add_argument("--jobs", metavar="N", default=1, type=validate_jobs,
+                    help="read directories with N threads for '**' patterns")
+parser.add_argument("--procs", metavar="N", default=1, type=validate_jobs,
+                    help="apply filters with N processes")
+parser.add_argument("--parallel-renames", metavar="N", default=1, type=validate_jobs,
+                    help="rename independent files with N threads")
+parser.add_argument("--journal", metavar="FILE",
+                    help="record renames in FILE for --recover")
+parser.add_argument("--recover", nargs="+", action=RecoverAction,
+                    help="finish or undo renames recorded in a journal")
+parser.add_argument("--summary", metavar="N", nargs="?", const=10, type=validate_jobs,
+                    help="show counts and the first N files (default: 10)")
+parser.add_argument("--stream", action="store_true",
+                    help="show files in the order found, without sorting")
+parser.add_argument("--plan-out", metavar="FILE",
+                    help="write renames and conflicts to FILE instead of renaming")
+parser.add_argument("--plan-in", metavar="FILE",
+                    help="rename files from a plan written by --plan-out")
+parser.add_argument("--cache", metavar="FILE",
+                    help="reuse files and renames of unchanged directories from FILE")
 parser.add_argument("--dryrun", action="store_true",
                     help="run without renaming any files")
 verbositygroup.add_argument("-q", "--quiet", action="store_true",
@@ -385,6 +457,20 @@ def main():
     if args.verbose:
         helper.print_args(args)
 
+    if args.recover:
+        journal.recover(*args.recover)
+        return
+
+    if args.plan_in:
+        # skip finding and filtering files, renames are checked again
+        cache = scanner.DirCache()
+        src_files, dest_files = plan.read_plan(args.plan_in)
+        missing = [f for f in src_files if not cache.exists(f)]
+        if missing:
+            sys.exit("Files in plan not found: " + ", ".join(repr(f) for f in missing[:10]))
+        renamer.finish_rename(src_files, dest_files, args, helper.SortKeys(), cache)
+        return
+
     if not check_optional(args):
         parser.print_usage()
         print("\nNo optional arguments set for renaming")
@@ -393,31 +479,52 @@ def main():
     if args.esc:
         args.path = helper.escape_path(args.path, args.esc)
 
+    sortkeys = helper.SortKeys()
+    store = PlanCache.load(args.cache) if args.cache else None
+    cache = scanner.DirCache(store)
     try:
-        files = glob_files(args.path)
-    except OSError as err:
-        raise argparse.ArgumentParser.error("An error occurred while searching for files: " + str(err))
-
-    if not files:
-        helper.print_nofiles()
-        return
-
-    if args.sel:
-        files = selection_tui.main(files)
-        if files is None:
-            return
-        elif files == []:
-            print("No files selected")
-            return
+        try:
+            files = glob_files(args.path, args.jobs, sortkeys, cache)
+        except OSError as err:
+            raise argparse.ArgumentParser.error("An error occurred while searching for files: " + str(err))
 
-    if args.sort == "man":
-        files = arrange_tui.main(files)
         if not files:
+            helper.print_nofiles()
             return
-    elif args.sort == "desc":
-        files.reverse()
-
-    if args.verbose:
-        helper.print_found(files)
 
-    renamer.start_rename(files, args)
+        preview = None
+        if args.preview and (args.sel or args.sort == "man"):
+            from batchren.tui.preview import PreviewPlanner
+            if args.sequence:
+                args.sequence.set_cache(cache)
+            filters = renamer.initfilters(args)
+            preview = partial(PreviewPlanner, filters=filters, ext=args.extension, raw=args.raw, cache=cache)
+
+        # urwid is slow to import, only load it for the tui
+        if args.sel:
+            from batchren.tui import selection_tui
+            files = selection_tui.main(files, preview)
+            if files is None:
+                return
+            elif files == []:
+                print("No files selected")
+                return
+
+        if args.sort == "man":
+            from batchren.tui import arrange_tui
+            files = arrange_tui.main(files, sortkeys, preview)
+            if not files:
+                return
+        elif args.sort == "desc":
+            files.reverse()
+
+        if args.verbose:
+            helper.print_found(files)
+
+        renamer.start_rename(files, args, sortkeys, cache)
+    finally:
+        if store is not None:
+            try:
+                store.save()
+            except OSError as err:
+                print("Cannot write cache: " + str(err))
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+from batchren import scanner, StringSeq
+
+# options that don't change the dest of a file
+IGNORED = {"dryrun", "quiet", "verbose", "path", "sort", "sel", "esc", "jobs", "procs",
+           "parallel_renames", "journal", "recover", "summary", "stream", "plan_out",
+           "plan_in", "cache", "preview"}
+
+# cache files of other versions are ignored
+VERSION = 2
+
+# directories changed this recently may change again within the same mtime
+RACY_NS = 2 * 10**9
+
+
+class PlanCache:
+    """Persistent cache of directory listings and renames.\n
+    Each directory is stored with its modification time, its entries
+    and the dests of its files for one set of renaming arguments.
+    Directories are stored by absolute path, so one cache can be
+    shared by runs in different directories.
+    A directory is only reused while its modification time is unchanged.\n
+    Directories are kept in least recently used order. When the total
+    number of entries is over size, the oldest directories are dropped.
+    """
+    def __init__(self, path=None, size=1000000):
+        self.path = path
+        self.size = size
+        self.dirs = OrderedDict()
+        self.fresh = set()
+        # time.time_ns is new in Python 3.7
+        self.now = int(time.time() * 10**9)
+        self.hits = 0
+
+    @classmethod
+    def load(cls, path, size=1000000):
+        """Load cache from path, start empty if it can't be read """
+        plans = cls(path, size)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == VERSION:
+                plans.dirs = OrderedDict(data["dirs"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return plans
+
+    def save(self):
+        """Write cache to its path, replacing the old file atomically """
+        total = sum(len(rec["entries"]) for rec in self.dirs.values())
+        while total > self.size and self.dirs:
+            _, rec = self.dirs.popitem(last=False)
+            total -= len(rec["entries"])
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"version": VERSION, "dirs": list(self.dirs.items())}, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def scandir(self, dirname, readdir):
+        """Return entries of a directory from the cache if it hasn't changed,
+        otherwise read it with readdir and store it.
+        """
+        key = _storekey(dirname)
+        try:
+            mtime = os.stat(dirname or os.curdir).st_mtime_ns
+        except OSError:
+            return readdir(dirname)
+
+        rec = self.dirs.get(key)
+        if rec is not None and rec["mtime"] == mtime:
+            self.dirs.move_to_end(key)
+            self.fresh.add(key)
+            return [CachedEntry(dirname, *e) for e in rec["entries"]]
+
+        entries = readdir(dirname)
+        self.dirs.pop(key, None)
+        if mtime < self.now - RACY_NS:
+            self.dirs[key] = {
+                "mtime": mtime,
+                "entries": [[e.name, scanner._is_dir(e), _is_file(e)] for e in entries]
+            }
+            self.fresh.add(key)
+        return entries
+
+    def signature(self, args):
+        """Return hash of the arguments that decide dests.\n
+        Return None if dests can't be cached, i.e. a sequence uses
+        file metadata, which can change without the directory.
+        """
+        seq = args.sequence
+        if seq and any(t in StringSeq.METADATA for t, _ in seq.get_rules()):
+            return None
+        items = {}
+        for k, v in vars(args).items():
+            if k not in IGNORED:
+                items[k] = _plain(v)
+                if items[k] is _UNKNOWN:
+                    return None
+        data = json.dumps(items, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def renames(self, src_files, sig, get_renames):
+        """Return dests for src_files, reusing dests of unchanged directories.\n
+        get_renames(files) is called once with files of every other
+        directory. Sequences restart in each directory, so dests are
+        only reused if every directory's files are together.
+        """
+        runs = []
+        for src in src_files:
+            dirpath, _ = os.path.split(src)
+            if runs and runs[-1][0] == dirpath:
+                runs[-1][1].append(src)
+            else:
+                runs.append((dirpath, [src]))
+        keys = [_storekey(dirpath) for dirpath, _ in runs]
+        if sig is None or len(set(keys)) != len(keys):
+            return get_renames(src_files)
+
+        cached = []
+        todo = []
+        for key, (dirpath, files) in zip(keys, runs):
+            rec = self.dirs.get(key) if self._fresh(key, dirpath) else None
+            if rec is not None and rec.get("sig") == sig and rec.get("files") == files:
+                cached.append(rec["dests"])
+                self.hits += 1
+            else:
+                cached.append(None)
+                todo.extend(files)
+
+        computed = iter(get_renames(todo) if todo else [])
+        dest_files = []
+        for key, (_, files), dests in zip(keys, runs, cached):
+            if dests is None:
+                dests = [next(computed) for _ in files]
+                if key in self.fresh:
+                    self.dirs[key].update(sig=sig, files=files, dests=dests)
+            dest_files.extend(dests)
+        return dest_files
+
+    def _fresh(self, key, dirpath):
+        """Return True if the stored directory hasn't changed """
+        if key in self.fresh:
+            return True
+        rec = self.dirs.get(key)
+        try:
+            if rec is None or rec["mtime"] != os.stat(dirpath or os.curdir).st_mtime_ns:
+                return False
+        except OSError:
+            return False
+        self.fresh.add(key)
+        return True
+
+
+class CachedEntry:
+    """Stand-in for os.DirEntry built from a stored listing """
+    __slots__ = ("name", "path", "_is_dir", "_is_file", "_stat")
+
+    def __init__(self, dirname, name, is_dir, is_file):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._is_dir = is_dir
+        self._is_file = is_file
+        self._stat = None
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_file(self):
+        return self._is_file
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def inode(self):
+        return os.lstat(self.path).st_ino
+
+
+def _storekey(dirname):
+    """Return key of a directory in the cache file.\n
+    One cache file can be shared by runs in different directories,
+    so keys are absolute, unlike keys of scanner.DirCache.
+    """
+    return os.path.abspath(dirname or os.curdir)
+
+
+_UNKNOWN = object()
+# re.Pattern is only named from Python 3.7
+_PATTERN = type(re.compile(""))
+
+
+def _plain(value):
+    """Return value as plain JSON data for a signature.\n
+    Reprs of objects can be cut short (e.g. long regex patterns),
+    so each type is spelled out. Return _UNKNOWN for other types.
+    """
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        res = [_plain(v) for v in value]
+        return _UNKNOWN if any(v is _UNKNOWN for v in res) else res
+    if isinstance(value, _PATTERN):
+        return {"pattern": value.pattern, "flags": value.flags}
+    if isinstance(value, slice):
+        return {"slice": [value.start, value.stop, value.step]}
+    if isinstance(value, StringSeq.StringSequence):
+        return {"sequence": value.get_argstr()}
+    return _UNKNOWN
+
+
+def _is_file(entry):
+    try:
+        return entry.is_file()
+    except OSError:
+        return False
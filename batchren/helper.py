@@ -1,11 +1,38 @@
 #!/usr/bin/env python3
 import os
 import re
+import sys
 
 BOLD = "\033[1m"
 END = "\033[0m"
 
 
+class SortKeys(dict):
+    """Cache of natural sort keys for paths.\n
+    A key is computed the first time a path is looked up and reused
+    by every later sort, so each path is only tokenized once.
+    natsort is only imported once a key is needed.
+    """
+    def __init__(self):
+        super().__init__()
+        self._keygen = None
+
+    @property
+    def keygen(self):
+        if self._keygen is None:
+            from natsort import natsort_keygen, ns
+            self._keygen = natsort_keygen(alg=ns.PATH)
+        return self._keygen
+
+    def __missing__(self, path):
+        key = self[path] = self.keygen(path)
+        return key
+
+    def sort(self, paths, reverse=False):
+        """Return a new list of paths in natural order """
+        return sorted(paths, key=self.__getitem__, reverse=reverse)
+
+
 def askQuery():
     valid = {"yes": True, "y": True, "ye": True,
              "no": False, "n": False, "q": False}
@@ -20,6 +47,26 @@ def askQuery():
             print("Please respond with 'yes' or 'no'")
 
 
+def write_lines(lines, out=None, size=65536):
+    """Write an iterable of strings to out (default: stdout).\n
+    Strings are joined and written in chunks of about size characters,
+    so large outputs don't make a write call for every line.
+    """
+    if out is None:
+        out = sys.stdout
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            out.write("".join(chunk))
+            chunk.clear()
+            length = 0
+    out.write("".join(chunk))
+    out.flush()
+
+
 def print_nofiles():
     print("{:-^30}".format(BOLD + "files found" + END))
     print("no files found\n")
@@ -66,66 +113,62 @@ def bracket_map(expression):
     return (open_map, close_map)
 
 
-def bracket_remove(expression, open_map, close_map, count):
-    stack = { "round": [], "square": [], "curly": [] }
-    indices = []
-
-    # find indices of matched/unmatched brackets using three stacks
-    for index, char in enumerate(expression):
+def bracket_table(open_map, close_map):
+    """Compile a pattern that finds every bracket in the maps """
+    chars = "".join(sorted(set(open_map) | set(close_map)))
+    return re.compile("[{}]".format(re.escape(chars))) if chars else None
+
+
+def bracket_remove(expression, open_map, close_map, count, table=None):
+    """Remove brackets and their contents from expression.\n
+    Brackets of each type are matched with a stack, unmatched brackets
+    are removed on their own. If count is set, only the count-th bracket
+    (by position of its opening) is removed, if it is matched.
+    table is the pattern from bracket_table, compiled if not given.\n
+    Spans are found in a single pass in order of their start, so kept
+    text is joined once instead of deleting each span from a list.
+    """
+    if table is None:
+        table = bracket_table(open_map, close_map)
+        if table is None:
+            return expression
+
+    stack = {kind: [] for kind in close_map.values()}
+    spans = []
+    for match in table.finditer(expression):
+        index = match.start()
+        char = expression[index]
         if char in open_map:
-            stack[open_map[char]].append(index)
-        elif char in close_map:
-            if not stack[close_map[char]]:
-                # move indices of unmatched closed braces
-                indices.append((index, index))
-                continue
-
-            i = stack[close_map[char]].pop()
-            indices.append((i, index))
-
-    # move indices of unmatched open braces to stack
-    for k, v in stack.items():
-        for vi in v:
-            indices.append((vi, vi))
-
-    if not indices:
+            stack[open_map[char]].append(len(spans))
+            spans.append([index, index])
+        elif stack[close_map[char]]:
+            spans[stack[close_map[char]].pop()][1] = index
+        else:
+            # unmatched closed brace
+            spans.append([index, index])
+
+    if not spans:
         # no indices to remove, just return the expression
         return expression
 
-    indices = sorted(indices, key=lambda x: x[0])
-    if not count:
-        indices = fold_indices(indices)
-
-    s = list(expression)
-    cur = len(indices)
-    while(indices):
-        start, end = indices.pop()
-
-        if not count:
-            del s[start:end+1]
-        elif count and cur == count:
-            if start != end:
-                del s[start:end + 1]
-        cur -= 1
-
-    return "".join(s)
-
-
-def fold_indices(indices):
-    # join overlapping indices
-    indices = sorted(indices, key=lambda x: x[0])
-    min_start, max_end = indices[0]
-
-    remove_indices = [indices[0]]
-    for start, end in indices[1:]:
-        if start > max_end:
-            remove_indices.append((start, end))
-            min_start, max_end = start, end
-        elif end > max_end:
-            remove_indices[-1] = (min_start, end)
-            max_end = end
-
-    return remove_indices
+    if count:
+        if count > len(spans):
+            return expression
+        start, end = spans[count - 1]
+        if start == end:
+            return expression
+        return expression[:start] + expression[end + 1:]
+
+    # join overlapping spans, keeping the text between them
+    kept = []
+    pos = 0
+    for start, end in spans:
+        if start >= pos:
+            kept.append(expression[pos:start])
+        if end >= pos:
+            pos = end + 1
+    kept.append(expression[pos:])
+    return "".join(kept)
 
 
 def escape_path(path, args):
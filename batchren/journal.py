@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import json
+import os
+import sys
+import threading
+
+
+class Journal:
+    """Append-only journal of a rename run, one JSON record per line.\n
+    Every planned rename is written and synced before the first file
+    is renamed. Completed renames are synced in batches, so a crash
+    may lose the last few. Recovery checks the filesystem for those.\n
+    Records:\n
+    -   begin: working directory of the run
+    -   plan: chain number, src, dest and inode of the file renamed
+    -   hop: a rename in a chain was moved to a temporary name first
+    -   done: chain number and index of a completed rename
+    -   rollback: renames are being undone
+    -   end: run finished
+    """
+    def __init__(self, path, batch=1000):
+        self.path = path
+        self.batch = batch
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def plan(self, chains, inode=None):
+        """Record every rename in chains and sync before renaming.\n
+        inode(path) gives the inode of each file, which recovery uses
+        to tell where a file is. A file renamed to a temporary name
+        keeps its inode for the rename out of it.
+        """
+        with self.lock:
+            self.write({"op": "begin", "cwd": os.getcwd()})
+            for n, chain in enumerate(chains):
+                moved = {}
+                for src, dest in chain:
+                    ino = moved.pop(src) if src in moved else _inode(src, inode)
+                    moved[dest] = ino
+                    self.write({"op": "plan", "chain": n, "src": src, "dest": dest, "ino": ino})
+            self.sync()
+
+    def hop(self, chain, index, tmp):
+        """Record that a rename goes to tmp first, then to its dest last """
+        with self.lock:
+            self.write({"op": "hop", "chain": chain, "index": index, "dest": tmp})
+            self.sync()
+
+    def done(self, chain, index):
+        with self.lock:
+            self.write({"op": "done", "chain": chain, "index": index})
+            self.pending += 1
+            if self.pending >= self.batch:
+                self.sync()
+
+    def rollback(self):
+        with self.lock:
+            self.write({"op": "rollback"})
+            self.sync()
+
+    def close(self):
+        with self.lock:
+            self.write({"op": "end"})
+            self.sync()
+            self.file.close()
+
+
+def read(path):
+    """Read the last run in a journal.\n
+    Return the working directory, list of chains of (src, dest),
+    number of renames recorded as done in each chain and whether
+    renames were being undone. Each rename is (src, dest, inode).
+    A cut short last line is ignored.
+    """
+    cwd, chains, done, undone = None, [], [], False
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break
+            op = rec.get("op")
+            if op == "begin":
+                cwd, chains, done, undone = rec["cwd"], [], [], False
+            elif op == "plan":
+                while len(chains) <= rec["chain"]:
+                    chains.append([])
+                    done.append(0)
+                chains[rec["chain"]].append((rec["src"], rec["dest"], rec.get("ino")))
+            elif op == "hop":
+                chain = chains[rec["chain"]]
+                src, dest, ino = chain[rec["index"]]
+                chain[rec["index"]] = (src, rec["dest"], ino)
+                chain.append((rec["dest"], dest, ino))
+            elif op == "done":
+                done[rec["chain"]] = max(done[rec["chain"]], rec["index"] + 1)
+            elif op == "rollback":
+                undone = True
+    return cwd, chains, done, undone
+
+
+def count_done(chain, count=0):
+    """Count renames done in a chain, starting from count known renames.\n
+    Renames in a chain are made in order and a file never goes back
+    to a name it was renamed from. So a rename is done unless its
+    file is still at src.
+    """
+    while count < len(chain):
+        src, _, ino = chain[count]
+        if _holds(src, ino):
+            break
+        count += 1
+    return count
+
+
+def recover(path, mode="forward"):
+    """Finish (forward) or undo (rollback) the renames in a journal """
+    cwd, chains, done, undone = read(path)
+    if cwd is None:
+        sys.exit("No renames found in journal '{}'".format(path))
+    # path may be relative to the directory recover was started in
+    path = os.path.abspath(path)
+    try:
+        os.chdir(cwd)
+    except OSError as err:
+        sys.exit("Cannot recover from journal: " + str(err))
+
+    # done records are unreliable once renames have been undone
+    counts = [count_done(chain, 0 if undone else n) for chain, n in zip(chains, done)]
+    journal = Journal(path)
+    if mode == "rollback":
+        journal.rollback()
+
+    try:
+        for n, (chain, count) in enumerate(zip(chains, counts)):
+            if mode == "forward":
+                for index in range(count, len(chain)):
+                    src, dest, _ = chain[index]
+                    _recover_rename(src, dest)
+                    journal.done(n, index)
+            else:
+                for src, dest, ino in reversed(chain[:count]):
+                    # renames may have been undone before a crash
+                    if _holds(dest, ino):
+                        _recover_rename(dest, src)
+    except OSError as err:
+        journal.sync()
+        sys.exit("Cannot recover from journal: " + str(err))
+
+    journal.close()
+    print("Recovery completed.")
+
+
+def _inode(path, inode=None):
+    try:
+        return inode(path) if inode is not None else os.lstat(path).st_ino
+    except OSError:
+        return None
+
+
+def _holds(path, ino):
+    """Return True if path exists and is the file with inode ino """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return ino is None or st.st_ino == ino
+
+
+def _recover_rename(src, dest):
+    if os.path.lexists(dest):
+        raise FileExistsError("'{}' already exists".format(dest))
+    print("rename '{}' to '{}'.".format(src, dest))
+    os.rename(src, dest)
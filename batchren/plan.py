@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import json
+import sys
+
+from batchren import helper
+
+
+def write_plan(path, queue, rentable):
+    """Write the rename queue and conflicts to path as JSON lines.\n
+    Records are written as they are generated, one per line:\n
+    -   {"type": "rename", "src": src, "dest": dest}
+    -   {"type": "conflict", "dest": dest, "srcs": [srcs], "err": [error codes]}
+    """
+    with open(path, "w", encoding="utf-8") as out:
+        helper.write_lines(plan_lines(queue, rentable), out)
+
+
+def plan_lines(queue, rentable):
+    for src, dest in queue:
+        yield json.dumps({"type": "rename", "src": src, "dest": dest}) + "\n"
+    for dest, obj in rentable["conflicts"].items():
+        rec = {"type": "conflict", "dest": dest, "srcs": obj["srcs"], "err": sorted(obj["err"])}
+        yield json.dumps(rec) + "\n"
+
+
+def read_plan(path):
+    """Read renames from a plan written by write_plan.\n
+    Return list of srcs and list of dests. Conflicts are skipped,
+    renames are checked again before they are made.
+    """
+    src_files, dest_files = [], []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for num, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    rec = json.loads(line)
+                    if rec["type"] == "rename":
+                        src_files.append(rec["src"])
+                        dest_files.append(rec["dest"])
+                except (ValueError, KeyError, TypeError):
+                    sys.exit("Invalid record in plan '{}' on line {}".format(path, num))
+    except OSError as err:
+        sys.exit("Cannot read plan: " + str(err))
+    return src_files, dest_files
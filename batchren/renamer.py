@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
+import heapq
 import os
 import re
 import sre_constants
+import sre_parse
 import sys
+import threading
 from collections import deque
+from functools import partial
+from itertools import islice
 
-from natsort import natsorted, ns
-
-from batchren import helper, StringSeq
+from batchren import helper, journal, plan, scanner, StringSeq
 
 
 issues = {
@@ -21,6 +24,8 @@ issues = {
     6: "shared name conflict",
 }
 
+dots = re.compile(r"\.+")
+
 
 def partfile(path, raw=False):
     """Split directory into directory, basename and/or extension """
@@ -44,14 +49,14 @@ def joinparts(dirpath, basename, ext, raw=False):
         if ext:
             # remove spaces, strip and then collapse dots from extension
             # remove trailing dots from filename before adding extension
-            ext = re.sub(r"\.+", ".", ext.replace(" ", "").strip("."))
+            ext = dots.sub(".", ext.replace(" ", "").strip("."))
             path = path.rstrip(".") + "." + ext
 
     else:
         # raw, don't process any whitespace
         if ext:
             # remove trailing dots from ext
-            ext = re.sub(r"\.+", ".", ext.strip("."))
+            ext = dots.sub(".", ext.strip("."))
             path = path.rstrip(".") + "." + ext
 
     if dirpath:
@@ -59,22 +64,99 @@ def joinparts(dirpath, basename, ext, raw=False):
     return path
 
 
+class FilterPipeline:
+    """Ordered list of filters to apply to a filename.\n
+    Filters are plain functions of the basename, or StringSequences
+    which also take the file path and directory.\n
+    compile() fuses consecutive plain functions into a single call
+    so per-file work is one call per stage.
+    """
+    def __init__(self, filters=None):
+        self.filters = list(filters) if filters else []
+        self.stages = None
+
+    def __iter__(self):
+        return iter(self.filters)
+
+    def __len__(self):
+        return len(self.filters)
+
+    def append(self, runf):
+        self.filters.append(runf)
+        self.stages = None
+
+    def compile(self):
+        """Group filters into stages of (is_sequence, function) """
+        stages = []
+        funcs = []
+        for runf in self.filters:
+            if isinstance(runf, StringSeq.StringSequence):
+                if funcs:
+                    stages.append((False, _fuse(funcs)))
+                    funcs = []
+                stages.append((True, runf))
+            else:
+                funcs.append(runf)
+        if funcs:
+            stages.append((False, _fuse(funcs)))
+        self.stages = stages
+        return self
+
+    def prepare(self, files):
+        """Let sequences compute their values for files in one call """
+        for runf in self.filters:
+            if isinstance(runf, StringSeq.StringSequence):
+                runf.prepare(files)
+
+    def __call__(self, path, dirpath, bname, pos=None):
+        """Apply filters to bname. If pos is given, sequences use it
+        as the file's (dir_index, file_index) instead of counting calls.
+        """
+        if self.stages is None:
+            self.compile()
+        for is_seq, runf in self.stages:
+            if is_seq:
+                if pos is None:
+                    bname = runf(path, dirpath, bname)
+                else:
+                    bname = runf.at(*pos, path, bname)
+            else:
+                bname = runf(bname)
+        return bname
+
+
+def _fuse(funcs):
+    """Compose functions into one, applied from left to right """
+    if len(funcs) == 1:
+        return funcs[0]
+
+    funcs = tuple(funcs)
+
+    def fused(x):
+        for f in funcs:
+            x = f(x)
+        return x
+    return fused
+
+
 def initfilters(args):
-    """Create functions in a list """
-    filters = []
+    """Create a compiled FilterPipeline from args """
+    filters = FilterPipeline()
     if args.regex:
         try:
-            repl = _repl_decorator(*args.regex)
+            regexes = regex_filters(args.regex)
         except re.error as re_err:
             sys.exit("A regex compilation error occurred: " + str(re_err))
         except sre_constants.error as sre_err:
             sys.exit("A regex compilation error occurred: " + str(sre_err))
-        filters.append(repl)
+        for regex in regexes:
+            filters.append(regex)
 
     if args.bracket_remove:
         maps = helper.bracket_map(args.bracket_remove[0])
         count = args.bracket_remove[1]
-        bracr = lambda x: helper.bracket_remove(x, *maps, count)
+        table = helper.bracket_table(*maps)
+        bracr = lambda x: helper.bracket_remove(x, *maps, count, table)
         filters.append(bracr)
 
     if args.slice:
@@ -82,7 +164,8 @@ def initfilters(args):
         filters.append(slash)
 
     if args.shave:
-        shave = lambda x: x[args.shave[0]][args.shave[1]]
+        head, tail = args.shave
+        shave = lambda x: x[head][tail]
         filters.append(shave)
 
     if args.translate:
@@ -91,84 +174,180 @@ def initfilters(args):
         filters.append(translate)
 
     if args.spaces is not None:
-        space = lambda x: re.sub(r"\s+", args.spaces, x)
+        space = partial(re.compile(r"\s+").sub, args.spaces)
         filters.append(space)
 
     if args.case:
         if args.case == "upper":
-            case = lambda x: x.upper()
+            case = str.upper
         elif args.case == "lower":
-            case = lambda x: x.lower()
+            case = str.lower
         elif args.case == "swap":
-            case = lambda x: x.swapcase()
+            case = str.swapcase
         elif args.case == "cap":
-            case = lambda x: str.title(x)
+            case = str.title
         filters.append(case)
 
     if args.sequence:
         filters.append(args.sequence)
 
-    if args.prepend is not None:
-        prepend = lambda x: args.prepend + x
-        filters.append(prepend)
-
-    if args.postpend is not None:
-        postpend = lambda x: x + args.postpend
-        filters.append(postpend)
-
+    prepend, postpend = args.prepend, args.postpend
+    if prepend is not None and postpend is not None:
+        pend = lambda x: prepend + x + postpend
+        filters.append(pend)
+    elif prepend is not None:
+        pend = lambda x: prepend + x
+        filters.append(pend)
+    elif postpend is not None:
+        pend = lambda x: x + postpend
+        filters.append(pend)
+
+    return filters.compile()
+
+
+class RegexFilter:
+    """Regex replacement filter.\n
+    Replace every match of pattern by repl, or if count is set, only
+    the count'th match by repl taken literally. Empty matches are
+    counted, but never replaced.\n
+    Keeps no state between calls, so it can be shared by threads.
+    """
+    def __init__(self, pattern, repl="", count=0):
+        self.pattern = re.compile(pattern)
+        self.repl = repl
+        self.count = count
+        self.sub = partial(self.pattern.sub, repl)
+        self.finditer = self.pattern.finditer
+
+    def __call__(self, x):
+        if not self.count:
+            return self.sub(x)
+        # stop at the count'th match, later matches are never searched for
+        match = next(islice(self.finditer(x), self.count - 1, None), None)
+        if match is None:
+            return x
+        start, end = match.span()
+        if start == end:
+            return x
+        return x[:start] + self.repl + x[end:]
+
+
+def regex_filters(regexes):
+    """Return a RegexFilter for each (pattern, repl, count) in order.\n
+    Consecutive removals of patterns that match exactly one character
+    are merged into one alternation, so a name is scanned once for all
+    of them. Removing a character can't create a new match for such a
+    pattern, so this gives the same name as removing them in turn.
+    """
+    filters, group = [], []
+    for pattern, repl, count in regexes:
+        pattern = re.compile(pattern)
+        if not repl and not count and _single_char(pattern):
+            if group and group[0].flags != pattern.flags:
+                filters.append(_merge_removals(group))
+                group = []
+            group.append(pattern)
+            continue
+        if group:
+            filters.append(_merge_removals(group))
+            group = []
+        filters.append(RegexFilter(pattern, repl, count))
+    if group:
+        filters.append(_merge_removals(group))
     return filters
 
 
-def _repl_decorator(pattern, repl="", count=0):
-    """Decorator function for regex replacement\n
-    Return one of two functions:\n
-        1. Normal re.sub
-        2. re.sub with counter to remove nth instance.
-    """
-    def repl_all(x):
-        return re.sub(pattern, repl, x)
-
-    def repl_nth(x):
-        f = re.sub(pattern, replacer, x, count)
-        replacer._count = 1
-        return f
-
-    def replacer(matchobj):
-        """Function to be used with re.sub\n
-        Replace string match with repl if count = count\n
-        Otherwise return the string match\n
-        """
-        if matchobj.group() and replacer._count == count:
-            res = repl
-        else:
-            res = matchobj.group()
-        replacer._count += 1
-        return res
+def _merge_removals(patterns):
+    if len(patterns) == 1:
+        return RegexFilter(patterns[0])
+    alternation = "|".join("(?:{})".format(p.pattern) for p in patterns)
+    return RegexFilter(re.compile(alternation, patterns[0].flags))
 
-    # initialise function attribute to one for use as a counter
-    replacer._count = 1
 
-    return repl_all if not count else repl_nth
+def _single_char(pattern):
+    """Return True if pattern matches exactly one character, regardless
+    of the characters around it, i.e. a literal, class or '.'.
+    Patterns with inline flags or groups are never merged.
+    """
+    if not isinstance(pattern.pattern, str) or "(?" in pattern.pattern:
+        return False
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except (re.error, sre_constants.error):
+        return False
+    return len(parsed) == 1 and parsed[0][0] in (
+        sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.IN, sre_constants.ANY)
 
 
-def start_rename(files, args):
+def start_rename(files, args, sortkeys=None, cache=None):
     src_files = files
     dest_files = files
+    if cache is None:
+        cache = scanner.DirCache()
+    if args.sequence:
+        args.sequence.set_cache(cache)
 
     try:
         filters = initfilters(args)
-        dest_files = get_renames(dest_files, filters, args.extension, args.raw)
-        rentable = generate_rentable(src_files, dest_files)
-        q = print_rentable(rentable, args.quiet, args.verbose)
+        renames = partial(get_renames, filters=filters, ext=args.extension, raw=args.raw, procs=args.procs)
+        if cache.store is not None:
+            # reuse dests of directories that haven't changed
+            dest_files = cache.store.renames(src_files, cache.store.signature(args), renames)
+        else:
+            dest_files = renames(src_files)
     except Exception as exc:
         sys.exit(exc)
+    finish_rename(src_files, dest_files, args, sortkeys, cache)
 
-    if q and helper.askQuery():
-        rename_queue(q, args.dryrun, args.verbose)
 
+def finish_rename(src_files, dest_files, args, sortkeys=None, cache=None):
+    """Check, show and make renames from src_files to dest_files.\n
+    If args.plan_out is set, write the plan there instead of renaming.
+    """
+    if cache is None:
+        cache = scanner.DirCache()
+    try:
+        try:
+            rentable = generate_rentable(src_files, dest_files, cache)
+            q = print_rentable(rentable, args.quiet, args.verbose, sortkeys, args.summary, args.stream)
+            if args.plan_out:
+                plan.write_plan(args.plan_out, q, rentable)
+        except BrokenPipeError:
+            raise
+        except Exception as exc:
+            sys.exit(exc)
+
+        if args.plan_out:
+            print("Plan written to '{}'".format(args.plan_out))
+            return
+        proceed = q and helper.askQuery()
+    except BrokenPipeError:
+        # reader went away (e.g. pager closed), while printing or asking
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit("Output closed, no files were renamed.")
+
+    if proceed:
+        # reread directories, they may have changed while waiting
+        cache.clear()
+        log = journal.Journal(args.journal) if args.journal and not args.dryrun else None
+        rename_queue(q, args.dryrun, args.verbose, cache, args.parallel_renames, log)
+
+
+def get_renames(src_files, filters, ext, raw, procs=1):
+    """Rename list of files with a list of functions.\n
+    If procs > 1, files are renamed by a pool of processes.
+    """
+    if not isinstance(filters, FilterPipeline):
+        filters = FilterPipeline(filters)
+    filters.compile()
+    filters.prepare(src_files)
+
+    if procs > 1 and len(src_files) > 1:
+        dest_files = _get_renames_parallel(src_files, filters, ext, raw, procs)
+        if dest_files is not None:
+            return dest_files
 
-def get_renames(src_files, filters, ext, raw):
-    """Rename list of files with a list of functions """
     dest_files = []
     for src in src_files:
         dest = runfilters(src, filters, ext, raw)
@@ -177,22 +356,69 @@ def get_renames(src_files, filters, ext, raw):
     return dest_files
 
 
-def runfilters(path, filters, extension=None, raw=False):
-    """Rename file with a list of functions """
+def _get_renames_parallel(src_files, filters, ext, raw, procs):
+    """Shard src_files across processes.\n
+    Sequences are given the position of each file in its directory,
+    so workers can compute their values in any order.
+    Return None if this can't be done, e.g. no filters or the
+    platform can't fork, so the caller falls back to a serial run.
+    """
+    if not filters.stages:
+        return None
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+        # workers inherit the filters by forking, lambdas can't be pickled
+        ctx = multiprocessing.get_context("fork")
+    except ValueError:
+        return None
+
+    pos = None
+    if any(is_seq for is_seq, _ in filters.stages):
+        pos = StringSeq.positions(src_files)
+    size = -(-len(src_files) // (procs * 4))
+    chunks = [(src_files[i:i + size], pos[i:i + size] if pos else None)
+              for i in range(0, len(src_files), size)]
+
+    try:
+        executor = ProcessPoolExecutor(procs, mp_context=ctx)
+    except TypeError:
+        # mp_context is new in Python 3.7, before that the default must fork
+        if multiprocessing.get_start_method() != "fork":
+            return None
+        executor = ProcessPoolExecutor(procs)
+
+    # forked workers inherit _worker, no initializer needed
+    global _worker
+    _worker = (filters, ext, raw)
+    dest_files = []
+    try:
+        with executor:
+            for dests in executor.map(_plan_chunk, chunks):
+                dest_files.extend(dests)
+    finally:
+        _worker = None
+
+    return dest_files
+
+
+_worker = None
+
+
+def _plan_chunk(chunk):
+    """Run the worker's filters on a chunk of (paths, positions) """
+    paths, pos = chunk
+    filters, ext, raw = _worker
+    if pos is None:
+        return [runfilters(path, filters, ext, raw) for path in paths]
+    return [runfilters(path, filters, ext, raw, p) for path, p in zip(paths, pos)]
+
+
+def runfilters(path, filters, extension=None, raw=False, pos=None):
+    """Rename file with a FilterPipeline or a list of functions """
     dirpath, bname, ext = partfile(path, raw)
-    for runf in filters:
-        try:
-            if isinstance(runf, StringSeq.StringSequence):
-                bname = runf(path, dirpath, bname)
-            else:
-                bname = runf(bname)
-        except re.error as re_err:
-            sys.exit("A regex error occurred: " + str(re_err))
-        except OSError as os_err:
-            # except oserror from sequences
-            sys.exit("A filesystem error occurred: " + str(os_err))
-        except Exception as exc:
-            sys.exit("An unforeseen error occurred: " + str(exc))
+    bname = _apply(filters, path, dirpath, bname, pos)
 
     # change extension, allow '' as an extension
     if extension is not None:
@@ -203,163 +429,278 @@ def runfilters(path, filters, extension=None, raw=False):
     return res
 
 
-def generate_rentable(src_files, dest_files):
-    """Generate a table of files that can and cannot be renamed """
+def _apply(filters, path, dirpath, bname, pos=None):
+    """Apply filters to basename, exit on errors """
+    if not isinstance(filters, FilterPipeline):
+        filters = FilterPipeline(filters)
+
+    try:
+        return filters(path, dirpath, bname, pos)
+    except re.error as re_err:
+        sys.exit("A regex error occurred: " + str(re_err))
+    except OSError as os_err:
+        # except oserror from sequences
+        sys.exit("A filesystem error occurred: " + str(os_err))
+    except Exception as exc:
+        sys.exit("An unforeseen error occurred: " + str(exc))
+
+
+def generate_rentable(src_files, dest_files, cache=None, check=None):
+    """Generate a table of files that can and cannot be renamed.\n
+    Files form a graph with an edge from src to dest. A src can't be
+    renamed if it has an error, shares a dest with an earlier src, or
+    renames to a src that can't be renamed. Files are marked in the
+    order they would have been found, and marks spread backwards
+    along the edges using an index from dest to src.\n
+    Existing files are looked up in cache, a scanner.DirCache.
+    Errors of each file come from check(src, dest, fileset, cache),
+    rename_errors by default.
+    """
     if len(src_files) != len(dest_files):
         raise ValueError("src list and dest list must have the same length")
+    if cache is None:
+        cache = scanner.DirCache()
+    if check is None:
+        check = rename_errors
 
     fileset = set(src_files)
+    size = len(src_files)
+
+    # index from dest to the first and second src renaming to it
+    first, second = {}, {}
+    for n, dest in enumerate(dest_files):
+        if dest not in first:
+            first[dest] = n
+        elif dest not in second:
+            second[dest] = n
+
+    # buckets[t] holds files that become unresolvable at step t
+    errors = [None] * size
+    buckets = [[] for _ in range(size)]
+    for n, (src, dest) in enumerate(zip(src_files, dest_files)):
+        if first[dest] != n:
+            # shares a dest with an earlier file
+            buckets[n].append(n)
+            continue
+        errors[n] = check(src, dest, fileset, cache)
+        if errors[n]:
+            buckets[n].append(n)
+        elif dest in second:
+            # the shared name conflict is found at the second file
+            buckets[second[dest]].append(n)
+
+    # walk steps in order, spreading marks along reverse edges
+    marked = [None] * size
+    unresolvable = {}
+    for step in range(size):
+        for n in buckets[step]:
+            if marked[n] is not None:
+                continue
+            marked[n] = step
+            src = src_files[n]
+            if src in unresolvable:
+                continue
+            unresolvable[src] = step
+            prev = first.get(src)
+            if prev is not None and marked[prev] is None:
+                # a file that wants src is marked when it's found,
+                # or now if it has already been found
+                buckets[max(prev, step)].append(prev)
+
     rentable = {
         "renames": {},
         "conflicts": {},
-        "unresolvable": set()
+        "unresolvable": set(unresolvable)
     }
+    conflicts = rentable["conflicts"]
+    for n, (src, dest) in enumerate(zip(src_files, dest_files)):
+        if first[dest] != n:
+            if dest in conflicts:
+                conflicts[dest]["srcs"].append(src)
+                conflicts[dest]["err"].add(6)
+            else:
+                # first file was still waiting to be renamed
+                errset = {0, 6} if dest == src else {6}
+                conflicts[dest] = {"srcs": [src_files[first[dest]], src], "err": errset}
+            continue
 
-    for src, dest in zip(src_files, dest_files):
-        errset = set()
-        if dest in rentable["conflicts"]:
-            # this name is already in conflict, add src to conflicts
-            rentable["conflicts"][dest]["srcs"].append(src)
-            rentable["conflicts"][dest]["err"].add(6)
-            errset = rentable["conflicts"][dest]["err"]
-            cascade(rentable, src)
-
-        elif dest in rentable["renames"]:
-            # this name is taken, invalidate both names
-            if dest == src:
-                errset.add(0)
-            errset.add(6)
-
-            tmp = rentable["renames"][dest]
-            del rentable["renames"][dest]
-            rentable["conflicts"][dest] = {"srcs": [tmp, src], "err": errset}
-            for n in rentable["conflicts"][dest]["srcs"]:
-                cascade(rentable, n)
-
-        elif dest in rentable["unresolvable"]:
-            # file won't be renamed, assign to unresolvable
-            errset.add(6)
-            rentable["conflicts"][dest] = {"srcs": [src], "err": errset}
-            cascade(rentable, src)
-
-        else:
-            src_dir, _ = os.path.split(src)
-            dest_dir, dest_bname = os.path.split(dest)
-
-            if dest not in fileset and os.path.exists(dest):
-                # file exists but not in fileset, assign to unresolvable
-                errset.add(6)
+        step = unresolvable.get(dest)
+        if step is not None and step < n:
+            # dest was already unresolvable when this file was found
+            conflicts[dest] = {"srcs": [src], "err": {6}}
+        elif errors[n]:
+            conflicts[dest] = {"srcs": [src], "err": errors[n]}
+        elif marked[n] is None:
+            rentable["renames"][dest] = src
+        elif dest not in second or marked[n] < second[dest]:
+            # dest became unresolvable after this file was found
+            conflicts[dest] = {"srcs": [src], "err": {6}}
 
-            if dest == src:
-                # name hasn't changed, don't rename this
-                errset.add(0)
+    return rentable
 
-            if src_dir != dest_dir:
-                if dest and dest[-1] == "/":
-                    # cannot change file to directory
-                    errset.add(4)
-                else:
-                    # cannot change location of file
-                    errset.add(5)
 
-            if dest_bname == "":
-                # name is empty, don't rename this
-                errset.add(1)
-            elif dest_bname[0] == ".":
-                # . is reserved in unix
-                errset.add(2)
+def rename_errors(src, dest, fileset, cache):
+    """Return set of issue codes for renaming src to dest """
+    errset = set()
+    src_dir, _ = os.path.split(src)
+    dest_dir, dest_bname = os.path.split(dest)
 
-            if len(dest_bname) > 255:
-                errset.add(3)
+    if dest not in fileset and cache.exists(dest):
+        # file exists but not in fileset, assign to unresolvable
+        errset.add(6)
 
-            if errset:
-                rentable["conflicts"][dest] = {"srcs": [src], "err": errset}
-                cascade(rentable, src)
+    if dest == src:
+        # name hasn't changed, don't rename this
+        errset.add(0)
 
-        if not errset:
-            rentable["renames"][dest] = src
+    if src_dir != dest_dir:
+        if dest and dest[-1] == "/":
+            # cannot change file to directory
+            errset.add(4)
+        else:
+            # cannot change location of file
+            errset.add(5)
 
-    return rentable
+    if dest_bname == "":
+        # name is empty, don't rename this
+        errset.add(1)
+    elif dest_bname[0] == ".":
+        # . is reserved in unix
+        errset.add(2)
 
+    if len(dest_bname) > 255:
+        errset.add(3)
 
-def cascade(rentable, target):
-    """Search through rename table and cascade file errors.\n
-    Mark src as unresolvable and cascade anything else
-    that wants to rename to src.
-    """
-    ndest = target
-    while True:
-        rentable["unresolvable"].add(ndest)
-        if ndest in rentable["renames"]:
-            tmp = rentable["renames"][ndest]
-            del rentable["renames"][ndest]
-            rentable["conflicts"][ndest] = {"srcs": [tmp], "err": {6}}
-            ndest = tmp
-            continue
-        return
+    return errset
 
 
-def print_rentable(rentable, quiet=False, verbose=False):
+def print_rentable(rentable, quiet=False, verbose=False, sortkeys=None,
+                   summary=None, stream=False, out=None):
     """Print contents of table.\n
     -   quiet: don't show errors
     -   verbose: show detailed errors
     -   verbose and no errors: show message
     -   not verbose and no errors: show nothing
     -   not verbose and errors: show unrenamable files
+    -   summary: show counts for each issue and the first summary files
+    -   stream: show files in the order they were found, without sorting
 
-    Always show output for renames
+    Always show output for renames.
+    Source paths are sorted with keys cached in sortkeys.
+    Output is written to out (default: stdout) in large chunks.
     """
-    ren = rentable["renames"]
+    if sortkeys is None:
+        sortkeys = helper.SortKeys()
+    if out is None:
+        out = sys.stdout
+
+    # return renames queue in (src, dest) order
+    ren = rentable["renames"].items()
+    if not stream:
+        ren = sorted(ren, key=lambda x: sortkeys[x[1]])
+    queue = [(src, dest) for dest, src in ren]
+
+    if summary:
+        lines = _summary_lines(rentable, queue, quiet, sortkeys, summary, stream)
+    else:
+        lines = _rentable_lines(rentable, queue, quiet, verbose, sortkeys, stream)
+    helper.write_lines(lines, out)
+    return queue
+
+
+def _rentable_lines(rentable, queue, quiet, verbose, sortkeys, stream):
+    """Generate lines of print_rentable """
     conf = rentable["conflicts"]
     unres = rentable["unresolvable"]
+    header = "{:-^30}\n"
 
     if quiet:
         # do nothing if quiet
         pass
 
     elif verbose:
-        print("{:-^30}".format(helper.BOLD + "issues/conflicts" + helper.END))
+        yield header.format(helper.BOLD + "issues/conflicts" + helper.END)
         if unres:
             # show detailed output if there were conflicts
-            print("the following files have conflicts:")
-            conflicts = natsorted(conf.items(), lambda x: x[0].replace(".", "~"), alg=ns.PATH)
+            yield "the following files have conflicts:\n"
+            conflicts = conf.items()
+            if not stream:
+                conflicts = sorted(conflicts, key=lambda x: sortkeys.keygen(x[0].replace(".", "~")))
             for dest, obj in conflicts:
-                srcOut = natsorted(obj["srcs"], alg=ns.PATH)
-                print(", ".join([repr(str(e)) for e in srcOut]))
-                print("--> '{}'\nerror(s): ".format(dest), end="")
-                print(", ".join([issues[e] for e in obj["err"]]), "\n")
+                srcOut = obj["srcs"] if stream else sortkeys.sort(obj["srcs"])
+                yield ", ".join([repr(str(e)) for e in srcOut]) + "\n"
+                yield "--> '{}'\nerror(s): ".format(dest)
+                yield ", ".join([issues[e] for e in obj["err"]]) + " \n\n"
         else:
             # otherwise show a message
-            print("no conflicts found", "\n")
+            yield "no conflicts found \n\n"
 
     elif unres:
         # show files that can't be renamed if not verbose or quiet
-        print("{:-^30}".format(helper.BOLD + "issues/conflicts" + helper.END))
-        print("the following files will NOT be renamed:")
-        print(*["'{}'".format(s) for s in natsorted(unres, alg=ns.PATH)], "", sep="\n")
+        yield header.format(helper.BOLD + "issues/conflicts" + helper.END)
+        yield "the following files will NOT be renamed:\n"
+        if stream:
+            srcs = (s for obj in conf.values() for s in obj["srcs"])
+        else:
+            srcs = sortkeys.sort(unres)
+        for s in srcs:
+            yield "'{}'\n".format(s)
+        yield "\n"
 
     # always show files that will be renamed
-    # return list of tuples (dest, src) sorted by src
-    print("{:-^30}".format(helper.BOLD + "rename" + helper.END))
-    renames = natsorted(ren.items(), key=lambda x: x[1], alg=ns.PATH)
-    if renames:
-        print("the following files can be renamed:")
-        for dest, src in renames:
-            print("'{}' rename to '{}'".format(src, dest))
+    yield header.format(helper.BOLD + "rename" + helper.END)
+    if queue:
+        yield "the following files can be renamed:\n"
+        for src, dest in queue:
+            yield "'{}' rename to '{}'\n".format(src, dest)
     else:
-        print("no files to rename")
-    print()
-
-    # return renames queue in (src, dest) order
-    return [(r[1], r[0]) for r in renames]
+        yield "no files to rename\n"
+    yield "\n"
+
+
+def _summary_lines(rentable, queue, quiet, sortkeys, count, stream):
+    """Generate lines of print_rentable with counts and count examples """
+    header = "{:-^30}\n"
+    if not quiet:
+        yield header.format(helper.BOLD + "issues/conflicts" + helper.END)
+        # group files by issue code
+        errors = {}
+        for dest, obj in rentable["conflicts"].items():
+            for e in obj["err"]:
+                errors.setdefault(e, []).extend((src, dest) for src in obj["srcs"])
+        if errors:
+            yield "{} files will NOT be renamed:\n".format(len(rentable["unresolvable"]))
+            for e, files in sorted(errors.items()):
+                yield "{:>8} {}\n".format(len(files), issues[e])
+                if stream:
+                    files = files[:count]
+                else:
+                    files = heapq.nsmallest(count, files, key=lambda x: sortkeys[x[0]])
+                for src, dest in files:
+                    yield "{:>8} '{}' --> '{}'\n".format("", src, dest)
+            yield "\n"
+        else:
+            yield "no conflicts found \n\n"
+
+    yield header.format(helper.BOLD + "rename" + helper.END)
+    if queue:
+        yield "{} files can be renamed:\n".format(len(queue))
+        for src, dest in queue[:count]:
+            yield "'{}' rename to '{}'\n".format(src, dest)
+        if len(queue) > count:
+            yield "... and {} more\n".format(len(queue) - count)
+    else:
+        yield "no files to rename\n"
+    yield "\n"
 
 
-def name_gen():
+def name_gen(cache=None, reserved=()):
+    exists = cache.exists if cache is not None else os.path.exists
     count = 0
     dirpath = ""
     while True:
         ret = os.path.join(dirpath, "tmp{}".format(count))
-        if os.path.exists(ret):
+        if ret in reserved or exists(ret):
             count += 1
             continue
         val = yield ret
@@ -370,48 +711,191 @@ def name_gen():
         count += 1
 
 
-def rename_queue(queue, dryrun=False, verbose=False):
-    """Rename src to dest from a list of tuples [(src, dest), ...] """
+def schedule_renames(queue, names):
+    """Order a list of tuples [(src, dest), ...] so every dest is free.\n
+    Dests must be unique, as in a rename table, so the files form
+    chains and cycles. A chain is renamed from the end with a free
+    dest back to its start. A cycle is broken by renaming one file
+    to a temporary name from names, which is renamed to its dest last.\n
+    Return the list of chains, each an ordered list of renames, and
+    the set of temporary names. Chains share no files.
+    """
+    dest_of = dict(queue)
+    src_of = {dest: src for src, dest in queue}
+    chains = []
+    temps = set()
+    seen = set()
+    for start, _ in queue:
+        if start in seen:
+            continue
+        steps = []
+        chains.append(steps)
+        # walk forward to the end of the chain or back to start
+        end = start
+        seen.add(end)
+        while dest_of[end] in dest_of and dest_of[end] != start:
+            end = dest_of[end]
+            seen.add(end)
+
+        if dest_of[end] == start:
+            # cycle, move start out of the way first
+            dirpath, _ = os.path.split(dest_of[start])
+            tmp = names.send(dirpath)
+            temps.add(tmp)
+            steps.append((start, tmp))
+            end = start
+        else:
+            steps.append((end, dest_of[end]))
+
+        # walk back along the chain, each dest has just been freed
+        src = src_of.get(end)
+        while src is not None and src != end:
+            seen.add(src)
+            steps.append((src, dest_of[src]))
+            src = src_of.get(src)
+        if src is not None:
+            # close the cycle
+            steps.append((tmp, dest_of[start]))
+
+    return chains, temps
+
+
+def count_queue_renames(queue):
+    """Count renames made by renaming in queue order.\n
+    Each file whose dest is still taken is moved to a temporary
+    name and queued again, as rename_queue did before scheduling.
+    """
     q = deque(queue)
+    taken = set(src for src, _ in queue)
+    count = 0
+    while q:
+        src, dest = q.popleft()
+        count += 1
+        taken.discard(src)
+        if dest in taken:
+            tmp = ("tmp", count)
+            taken.add(tmp)
+            q.append((tmp, dest))
+        else:
+            taken.add(dest)
+    return count
+
+
+def rename_queue(queue, dryrun=False, verbose=False, cache=None, jobs=1, journal=None):
+    """Rename src to dest from a list of tuples [(src, dest), ...]\n
+    Renames are ordered by schedule_renames, so each cycle needs
+    one temporary name. Existing files are looked up in cache, which
+    is updated after every rename. With dryrun the renames are only
+    made in the cache.\n
+    If jobs > 1, chains are renamed by a pool of threads. Each chain
+    keeps its own rollback log and the logs are merged on failure.\n
+    If journal is a journal.Journal, the schedule is recorded in it before
+    renaming and every rename is recorded once it's done.
+    """
     rollback_queue = []
+    if cache is None:
+        cache = scanner.DirCache()
 
-    n = name_gen()
+    n = name_gen(cache, set(dest for _, dest in queue))
     next(n)
+    chains, temps = schedule_renames(queue, n)
+    lock = threading.Lock()
+    if journal is not None:
+        journal.plan(chains, cache.inode)
 
     if dryrun:
         print("Running with dryrun, files will NOT be renamed.")
 
     try:
-        while q:
-            src, dest = q.popleft()
-            if os.path.exists(dest):
-                # rename in two parts
-                dirpath, _ = os.path.split(dest)
-                tmp = n.send(dirpath)
-                if verbose or dryrun:
-                    print("Conflict found, temporarily renaming '{}' to '{}'.".format(src, tmp))
-                if not dryrun:
-                    rename_file(src, tmp)
-                rollback_queue.append((tmp, src))
-                q.append((tmp, dest))
-            else:
-                # no conflict, just rename
-                if verbose or dryrun:
-                    print("rename '{}' to '{}'.".format(src, dest))
-                if not dryrun:
-                    rename_file(src, dest)
-                rollback_queue.append((dest, src))
+        if jobs > 1 and len(chains) > 1:
+            _rename_parallel(chains, rollback_queue, jobs, dryrun, verbose, cache, n, temps, lock, journal)
+        else:
+            for num, chain in enumerate(chains):
+                _rename_chain(chain, rollback_queue, dryrun, verbose, cache, n, temps, lock,
+                              journal=journal, num=num)
     except Exception:
         if dryrun:
             sys.exit("An error occurred but no files were renamed as the dryrun option is enabled.")
         elif not rollback_queue:
             sys.exit("No files were renamed due to an error.")
         else:
+            if journal is not None:
+                journal.rollback()
             rollback(rollback_queue)
 
+    if journal is not None:
+        journal.close()
+    if verbose or dryrun:
+        saved = count_queue_renames(queue) - len(rollback_queue)
+        print("{} renames made, {} saved by scheduling.".format(len(rollback_queue), saved))
     print("Finished renaming...")
 
 
+def _rename_parallel(chains, rollback_queue, jobs, dryrun, verbose, cache, names, temps, lock, journal=None):
+    """Rename chains with a pool of threads.\n
+    Once a chain fails no more renames are started. Every chain's log
+    is added to rollback_queue before the first error is raised.
+    Chains share no files, so each log only has to be undone in order.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    logs = [[] for _ in chains]
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_rename_chain, chain, chainlog, dryrun, verbose,
+                                   cache, names, temps, lock, stop, journal, num)
+                   for num, (chain, chainlog) in enumerate(zip(chains, logs))]
+    for chainlog in logs:
+        rollback_queue.extend(chainlog)
+    for future in futures:
+        future.result()
+
+
+def _rename_chain(chain, log, dryrun, verbose, cache, names, temps, lock, stop=None,
+                  journal=None, num=0):
+    """Rename a chain of (src, dest) in order, appending (dest, src) to log.\n
+    The cache, names and journal are shared between threads.
+    The cache and names are used under lock.
+    """
+    steps = list(chain)
+    index = 0
+    try:
+        while index < len(steps):
+            if stop is not None and stop.is_set():
+                return
+            src, dest = steps[index]
+            with lock:
+                conflict = cache.exists(dest)
+                if conflict:
+                    dirpath, _ = os.path.split(dest)
+                    tmp = names.send(dirpath)
+            if conflict:
+                # rename in two parts, the second is made last
+                if verbose or dryrun:
+                    print("Conflict found, temporarily renaming '{}' to '{}'.".format(src, tmp))
+                steps[index] = (src, tmp)
+                steps.append((tmp, dest))
+                if journal is not None:
+                    journal.hop(num, index, tmp)
+                dest = tmp
+            elif verbose or dryrun:
+                if dest in temps:
+                    print("Cycle found, temporarily renaming '{}' to '{}'.".format(src, dest))
+                else:
+                    print("rename '{}' to '{}'.".format(src, dest))
+            if not dryrun:
+                rename_file(src, dest)
+            with lock:
+                cache.rename(src, dest)
+            log.append((dest, src))
+            if journal is not None:
+                journal.done(num, index)
+            index += 1
+    except Exception:
+        if stop is not None:
+            stop.set()
+        raise
+
+
 def rollback(queue):
     print("Running file rollback...")
     while queue:
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import fnmatch
+import os
+import re
+from collections import Counter
+
+magic_check = re.compile(r"([*?[])")
+
+
+def has_magic(s):
+    return magic_check.search(s) is not None
+
+
+def scan_files(pattern, jobs=1, cache=None):
+    """Yield files matching a glob pattern.\n
+    Follows the same matching rules as glob.iglob(pattern, recursive=True),
+    but directories are read with os.scandir so DirEntry.is_file() can be
+    used instead of an extra stat for every match.\n
+    Paths are yielded as soon as their directory has been read.
+    If jobs > 1, directories under '**' are read by a pool of threads.
+    If cache is a DirCache, directory listings are kept in it.
+    """
+    if jobs > 1 and "**" in pattern:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            yield from _scan_files(pattern, executor, cache)
+    else:
+        yield from _scan_files(pattern, None, cache)
+
+
+def _scan_files(pattern, executor, cache):
+    for path, entry in _scan(pattern, False, executor, cache):
+        if entry is None:
+            # literal path, only now do we need to stat it
+            if os.path.isfile(path):
+                yield path
+        elif entry.is_file():
+            yield path
+
+
+def _scan(pathname, dironly, executor=None, cache=None):
+    """Yield (path, entry) for each match of pathname.\n
+    entry is the DirEntry from the directory read or None
+    if the path was matched literally.
+    """
+    dirname, basename = os.path.split(pathname)
+    if not has_magic(pathname):
+        if basename:
+            if os.path.lexists(pathname):
+                yield pathname, None
+        elif os.path.isdir(dirname):
+            # patterns ending with a slash only match directories
+            yield pathname, None
+        return
+
+    if not dirname:
+        for name, entry in _scan_in_dir(dirname, basename, dironly, executor, cache):
+            yield name, entry
+        return
+
+    if dirname != pathname and has_magic(dirname):
+        dirs = (d for d, _ in _scan(dirname, True, executor, cache))
+    else:
+        dirs = [dirname]
+
+    for dirname in dirs:
+        for name, entry in _scan_in_dir(dirname, basename, dironly, executor, cache):
+            yield os.path.join(dirname, name), entry
+
+
+def _scan_in_dir(dirname, basename, dironly, executor=None, cache=None):
+    if basename == "**":
+        # the directory itself is a match for '**'
+        if dironly:
+            yield "", None
+        if executor is not None:
+            yield from _scan_recursive_parallel(dirname, dironly, executor, cache)
+        else:
+            yield from _scan_recursive(dirname, dironly, cache)
+    elif has_magic(basename):
+        match = re.compile(fnmatch.translate(basename)).match
+        hidden = basename[0] == "."
+        for entry in _listdir(dirname, dironly, cache):
+            if (hidden or entry.name[0] != ".") and match(entry.name):
+                yield entry.name, entry
+    elif basename:
+        if os.path.lexists(os.path.join(dirname, basename)):
+            yield basename, None
+    elif os.path.isdir(dirname):
+        yield basename, None
+
+
+def _scan_recursive(dirname, dironly, cache=None):
+    """Yield (relative path, entry) for everything below dirname.\n
+    Hidden files and directories are skipped.
+    """
+    for entry in _listdir(dirname, dironly, cache):
+        if entry.name[0] == ".":
+            continue
+        yield entry.name, entry
+        if _is_dir(entry):
+            path = os.path.join(dirname, entry.name)
+            for name, subentry in _scan_recursive(path, dironly, cache):
+                yield os.path.join(entry.name, name), subentry
+
+
+def _scan_recursive_parallel(dirname, dironly, executor, cache=None):
+    """Yield (relative path, entry) for everything below dirname.\n
+    Each level of the tree is read by the executor. Results are merged
+    in submission order, so output is the same on every run.
+    """
+    level = [("", dirname)]
+    while level:
+        nextlevel = []
+        paths = [path for _, path in level]
+        listings = executor.map(_listdir_typed, paths, [dironly] * len(paths), [cache] * len(paths))
+        for (rel, path), entries in zip(level, listings):
+            for entry, isdir in entries:
+                if entry.name[0] == ".":
+                    continue
+                name = os.path.join(rel, entry.name) if rel else entry.name
+                yield name, entry
+                if isdir:
+                    nextlevel.append((name, os.path.join(path, entry.name)))
+        level = nextlevel
+
+
+def _listdir_typed(dirname, dironly, cache=None):
+    """Return list of (DirEntry, is_dir) so is_dir is resolved by the worker """
+    return [(entry, _is_dir(entry)) for entry in _listdir(dirname, dironly, cache)]
+
+
+def _listdir(dirname, dironly, cache=None):
+    """Return list of DirEntry in a directory, ignore unreadable directories """
+    if cache is not None:
+        entries = cache.scandir(dirname)
+    else:
+        entries = _readdir(dirname)
+    if not dironly:
+        return entries
+    return [entry for entry in entries if _is_dir(entry)]
+
+
+def _readdir(dirname):
+    try:
+        with os.scandir(dirname or os.curdir) as it:
+            return list(it)
+    except OSError:
+        return []
+
+
+def _is_dir(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+class DirCache:
+    """Cache of directory listings.\n
+    Each directory is read once with os.scandir and kept as a dict
+    of name to DirEntry. Existence checks are answered from the listing
+    and stats from the DirEntry, which keeps its stat after the first call.
+    Renames update the listing so it stays accurate during a run.\n
+    If store is a cache.PlanCache, listings of unchanged directories
+    are read from it instead of the filesystem.
+    """
+    def __init__(self, store=None):
+        self.dirs = {}
+        self.folded = {}
+        self.stats = {}
+        self.store = store
+
+    def clear(self):
+        self.dirs.clear()
+        self.folded.clear()
+        self.stats.clear()
+
+    def scandir(self, dirname):
+        """Return list of DirEntry in a directory, reading it at most once """
+        return [e for e in self.listdir(dirname).values() if e is not None]
+
+    def listdir(self, dirname):
+        """Return dict of name to DirEntry (None if added by a rename) """
+        key = _dirkey(dirname)
+        names = self.dirs.get(key)
+        if names is None:
+            if self.store is not None:
+                entries = self.store.scandir(dirname, _readdir)
+            else:
+                entries = _readdir(dirname)
+            names = {entry.name: entry for entry in entries}
+            self.dirs[key] = names
+        return names
+
+    def exists(self, path):
+        dirpath, name = os.path.split(path)
+        if not name or name in (os.curdir, os.pardir):
+            return os.path.exists(path)
+        names = self.listdir(dirpath)
+        if name in names:
+            return True
+        if self._folded(dirpath, names)[name.lower()]:
+            # might be a case insensitive filesystem, ask the os
+            return os.path.lexists(path)
+        return False
+
+    def _folded(self, dirpath, names):
+        key = _dirkey(dirpath)
+        folded = self.folded.get(key)
+        if folded is None:
+            folded = self.folded[key] = Counter(n.lower() for n in names)
+        return folded
+
+    def stat(self, path):
+        """Return stat result of path, made at most once per file """
+        dirpath, name = os.path.split(path)
+        entry = self.listdir(dirpath).get(name) if name else None
+        if entry is not None:
+            return entry.stat()
+        st = self.stats.get(path)
+        if st is None:
+            st = self.stats[path] = os.stat(path)
+        return st
+
+    def getmtime(self, path):
+        return self.stat(path).st_mtime
+
+    def inode(self, path):
+        dirpath, name = os.path.split(path)
+        entry = self.listdir(dirpath).get(name) if name else None
+        if entry is None:
+            return os.lstat(path).st_ino
+        return entry.inode()
+
+    def rename(self, src, dest):
+        """Record that src was renamed to dest """
+        src_dir, src_name = os.path.split(src)
+        dest_dir, dest_name = os.path.split(dest)
+        if self.listdir(src_dir).pop(src_name, False) is not False:
+            folded = self.folded.get(_dirkey(src_dir))
+            if folded is not None:
+                folded[src_name.lower()] -= 1
+        names = self.listdir(dest_dir)
+        if dest_name not in names:
+            names[dest_name] = None
+            folded = self.folded.get(_dirkey(dest_dir))
+            if folded is not None:
+                folded[dest_name.lower()] += 1
+
+
+def _dirkey(dirname):
+    return os.path.normpath(dirname) if dirname else os.curdir
@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 import os
+import random
+from collections import OrderedDict
 
 import urwid
 
+from batchren import helper
 from batchren._version import __version__
+from batchren.tui.preview import preview_markup
 
 version = "batchren " + __version__
 
+# directories with more files scroll inside their box
+MAX_ROWS = 20
 
-def create_selectable(text, padding=0):
+
+def create_selectable(text, padding=0, preview=None):
     if not text:
         text = "current working directory"
     sel = VariableSelectable(text)
-    item = urwid.AttrMap(urwid.Padding(sel, left=padding), None, focus_map="reversed")
-    return item
+    item = urwid.Padding(sel, left=padding)
+    if preview is not None:
+        # new name in a column next to the file
+        item = urwid.Columns([item, urwid.Text(preview)], dividechars=2)
+    return urwid.AttrMap(item, None, focus_map="reversed")
 
 
 class VariableSelectable(urwid.SelectableIcon):
@@ -32,51 +42,380 @@ class VariableSelectable(urwid.SelectableIcon):
         return self.enable_focus
 
 
+class _Node:
+    __slots__ = ("value", "priority", "size", "left", "right")
+
+    def __init__(self, value, priority):
+        self.value = value
+        self.priority = priority
+        self.size = 1
+        self.left = None
+        self.right = None
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _split(node, count):
+    """Split tree into a tree of the first count items and a tree of the rest """
+    if node is None:
+        return None, None
+    if _size(node.left) >= count:
+        left, node.left = _split(node.left, count)
+        node.size = _size(node.left) + _size(node.right) + 1
+        return left, node
+    node.right, right = _split(node.right, count - _size(node.left) - 1)
+    node.size = _size(node.left) + _size(node.right) + 1
+    return node, right
+
+
+def _merge(left, right):
+    """Join two trees, every item of left comes before right """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.size = _size(left.left) + _size(left.right) + 1
+        return left
+    right.left = _merge(left, right.left)
+    right.size = _size(right.left) + _size(right.right) + 1
+    return right
+
+
+def _build(values):
+    """Build a tree of values in order, in linear time """
+    stack = []
+    for value in values:
+        node = _Node(value, random.random())
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+            last.size = _size(last.left) + _size(last.right) + 1
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    root = None
+    while stack:
+        root = stack.pop()
+        root.size = _size(root.left) + _size(root.right) + 1
+    return root
+
+
+def _values(node):
+    """Yield values of a tree in order """
+    stack = []
+    while stack or node is not None:
+        while node is not None:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node.value
+        node = node.right
+
+
+class Arrangement:
+    """Sequence of items that can be moved around in O(log n).\n
+    Items are kept in a treap ordered by position, so looking up an item,
+    moving a block of items and sorting a range only touch the part of the
+    tree they need, instead of shifting every later item of a list.\n
+    Every change is recorded, so it can be undone and redone without
+    rebuilding the whole sequence. A move is stored as its positions,
+    a sort as the items of the range before and after.
+    """
+    def __init__(self, values=()):
+        self.root = _build(values)
+        self.done = []
+        self.undone = []
+        self.version = 0
+
+    def __len__(self):
+        return _size(self.root)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        node = self.root
+        while True:
+            left = _size(node.left)
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node.value
+            else:
+                index -= left + 1
+                node = node.right
+
+    def __iter__(self):
+        return _values(self.root)
+
+    def move(self, start, stop, dest):
+        """Move items in [start, stop) so the first of them ends up at dest """
+        if not 0 <= start < stop <= len(self) or not 0 <= dest <= len(self) - stop + start:
+            raise IndexError(dest)
+        if dest != start:
+            self._move(start, stop, dest)
+            self._record(("move", start, stop, dest))
+
+    def sort(self, start=0, stop=None, key=None, reverse=False):
+        """Sort items in [start, stop) in place """
+        if stop is None:
+            stop = len(self)
+        before = self._range(start, stop)
+        after = sorted(before, key=key, reverse=reverse)
+        if after != before:
+            self._replace(start, after)
+            self._record(("sort", start, before, after))
+
+    def undo(self):
+        """Revert the last change, return position of its items or None """
+        if not self.done:
+            return None
+        change = self.done.pop()
+        self.undone.append(change)
+        if change[0] == "move":
+            _, start, stop, dest = change
+            self._move(dest, dest + stop - start, start)
+        else:
+            _, start, before, _ = change
+            self._replace(start, before)
+        return start
+
+    def redo(self):
+        """Make the last undone change again, return position of its items or None """
+        if not self.undone:
+            return None
+        change = self.undone.pop()
+        self.done.append(change)
+        if change[0] == "move":
+            _, start, stop, dest = change
+            self._move(start, stop, dest)
+            return dest
+        _, start, _, after = change
+        self._replace(start, after)
+        return start
+
+    def reset(self):
+        """Undo every change, return True if there were any """
+        changed = bool(self.done)
+        while self.done:
+            self.undo()
+        return changed
+
+    def _record(self, change):
+        self.done.append(change)
+        self.undone.clear()
+
+    def _range(self, start, stop):
+        rest, right = _split(self.root, stop)
+        left, block = _split(rest, start)
+        values = list(_values(block))
+        self.root = _merge(_merge(left, block), right)
+        return values
+
+    def _move(self, start, stop, dest):
+        self.version += 1
+        rest, right = _split(self.root, stop)
+        left, block = _split(rest, start)
+        rest = _merge(left, right)
+        left, right = _split(rest, dest)
+        self.root = _merge(_merge(left, block), right)
+
+    def _replace(self, start, values):
+        """Replace items from start on with values """
+        self.version += 1
+        rest, right = _split(self.root, start + len(values))
+        left, _ = _split(rest, start)
+        self.root = _merge(_merge(left, _build(values)), right)
+
+
+class ArrangeWalker(urwid.ListWalker):
+    """List walker over an Arrangement of file indices.\n
+    Widgets are only made for rows being shown, rows in marked
+    are highlighted.\n
+    If planner is a preview.PreviewPlanner, new names are shown next
+    to files. Files of the directory are planner files from base on.
+    """
+    def __init__(self, files, cache_size=256, planner=None, dirpath="", base=0):
+        self.files = files
+        self.order = Arrangement(range(len(files)))
+        self.planner = planner
+        self.dirpath = dirpath
+        self.base = base
+        self.version = self.order.version
+        self.marked = None
+        self.widgets = OrderedDict()
+        self.cache_size = cache_size
+        self.focus = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        index = self.order[position]
+        widget = self.widgets.get(index)
+        if widget is not None:
+            self.widgets.move_to_end(index)
+            return widget
+        preview = None if self.planner is None else preview_markup(self.planner, self.base + index)
+        widget = create_selectable(self.files[index], 4, preview)
+        if self.marked is not None and self.marked[0] <= position < self.marked[1]:
+            widget.set_attr_map({None: "marked"})
+        self.widgets[index] = widget
+        if len(self.widgets) > self.cache_size:
+            self.widgets.popitem(last=False)
+        return widget
+
+    def next_position(self, position):
+        if position + 1 >= len(self):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self) - 1, -1, -1)
+        return range(len(self))
+
+    def changed(self, marked=None):
+        """Highlight rows in [start, stop) of marked, redraw every row """
+        self.marked = marked
+        if self.planner is not None and self.version != self.order.version:
+            # sequences and conflicts follow the new order
+            self.version = self.order.version
+            self.planner.reorder(self.dirpath, [self.base + n for n in self.order])
+        self.widgets.clear()
+        self._modified()
+
+
 class FileListBox(urwid.ListBox):
-    def __init__(self, dirpath, files):
+    """
+    ListBox of files in one directory that can be reordered.
+    enter picks up the focused file or the marked range and
+    enter again drops it at the focused row. space starts
+    or clears a range. n, m and s sort the range or the whole
+    directory by name, modification time and size, pressing
+    the same key again reverses the order. u undoes the last
+    change and ctrl r redoes it.
+    """
+    sortkeys = {"n": "name", "m": "mtime", "s": "size"}
+
+    def __init__(self, dirpath, files, sortkeys=None, planner=None, base=0):
         self.dirpath = dirpath
         self.files = files
+        self.paths = [os.path.join(dirpath, f) for f in files]
+        self.names = sortkeys if sortkeys is not None else helper.SortKeys()
+        self.stats = {}
 
-        self.activepos = None
-        self.toggle = False
+        self.anchor = None
+        self.picked = None
+        self.lastsort = None
         self.enable_focus = False
-
-        lst = [create_selectable(f, 4) for f in self.files]
-        body = urwid.SimpleFocusListWalker(lst)
-        super().__init__(body)
+        super().__init__(ArrangeWalker(files, planner=planner, dirpath=dirpath, base=base))
 
     def keypress(self, size, key):
         key = super().keypress(size, key)
-        if key != "enter":
+        if key == "enter":
+            if self.picked is None:
+                self.picked = self.marked_range()
+                self.anchor = None
+                self.body.changed(self.picked)
+            else:
+                self.drop()
+        elif key == " " and self.picked is None:
+            self.anchor = None if self.anchor is not None else self.focus_position
+            self.body.changed(self.marked_range() if self.anchor is not None else None)
+        elif key in self.sortkeys and self.picked is None:
+            self.sort(self.sortkeys[key])
+        elif key in ("u", "ctrl r") and self.picked is None:
+            pos = self.body.order.undo() if key == "u" else self.body.order.redo()
+            if pos is not None:
+                self.anchor = None
+                self.lastsort = None
+                self.body.changed()
+                self.focus_position = pos
+        else:
+            if self.anchor is not None and key is None:
+                # extend the range to the new focus
+                self.body.changed(self.marked_range())
             return key
 
-        if self.toggle:
-            # move activepos to current focus position
-            cur_pos = self.focus_position + 1 if len(self.body) == 1 else self.focus_position
-            item = self.body.pop(self.activepos)
-            self.body.insert(cur_pos, item)
-            self.activepos = None
-        elif not self.toggle:
-            self.activepos = self.focus_position
-        self.toggle = not self.toggle
+    def marked_range(self):
+        """Return [start, stop) from the anchor to the focus """
+        pos = self.focus_position
+        start = pos if self.anchor is None else self.anchor
+        return min(start, pos), max(start, pos) + 1
+
+    def drop(self):
+        """Move the picked range to the focused row """
+        start, stop = self.picked
+        pos = self.focus_position
+        if pos < start:
+            self.body.order.move(start, stop, pos)
+        elif pos >= stop:
+            self.body.order.move(start, stop, pos - (stop - start) + 1)
+        self.picked = None
+        self.body.changed()
+
+    def sort(self, name):
+        """Sort the marked range or the whole directory by name, mtime or size """
+        reverse = self.lastsort == name
+        self.lastsort = None if reverse else name
+        if name == "name":
+            key = self.names.__getitem__
+        else:
+            field = "st_mtime" if name == "mtime" else "st_size"
+            key = lambda path: getattr(self.stat(path), field, 0)
+        if self.anchor is not None:
+            start, stop = self.marked_range()
+        else:
+            start, stop = 0, len(self.body)
+        paths = self.paths
+        self.body.order.sort(start, stop, key=lambda n: key(paths[n]), reverse=reverse)
+        self.body.changed(self.marked_range() if self.anchor is not None else None)
+
+    def stat(self, path):
+        st = self.stats.get(path, False)
+        if st is False:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            self.stats[path] = st
+        return st
 
     def selectable(self):
         return self.enable_focus
 
     def toggle_focus(self):
-        self.activepos = None
-        self.toggle = False
+        self.anchor = None
+        self.picked = None
+        self.body.changed()
         self.enable_focus = not self.enable_focus
 
     def reset(self):
-        self.body[:] = [create_selectable(f, 4) for f in self.files]
-        self.activepos = None
-        self.toggle = False
+        # undo changes instead of rebuilding, they can be redone
+        self.body.order.reset()
+        self.anchor = None
+        self.picked = None
+        self.lastsort = None
         self.enable_focus = False
+        self.body.changed()
         self.focus_position = 0
 
     def get_output(self):
-        return [os.path.join(self.dirpath, wdgt.base_widget.text) for wdgt in self.body]
+        return [self.paths[n] for n in self.body.order]
 
 
 class DirectoryListBox(urwid.ListBox):
@@ -84,7 +423,7 @@ class DirectoryListBox(urwid.ListBox):
     DirectoryListBox that enables/disables focus
     for contained listboxes
     """
-    def __init__(self, files):
+    def __init__(self, files, sortkeys=None, preview=None):
         self.toggle = False
         d = {}
         for f in files:
@@ -94,12 +433,19 @@ class DirectoryListBox(urwid.ListBox):
             else:
                 d[dirpath] = [filename]
 
+        planner = None
+        if preview is not None:
+            # plan files in the order they are shown, one run per directory
+            planner = preview([os.path.join(key, f) for key, val in d.items() for f in val])
+
         lst = []
+        base = 0
         for key, val in d.items():
             # add a selectableicon, listbox and a blank space
             icon = create_selectable(key)
-            lstbox = urwid.BoxAdapter(FileListBox(key, val), height=len(val))
-            lst.extend([icon, lstbox, urwid.Divider()])
+            lstbox = FileListBox(key, val, sortkeys, planner, base)
+            lst.extend([icon, urwid.BoxAdapter(lstbox, height=min(len(val), MAX_ROWS)), urwid.Divider()])
+            base += len(val)
         body = urwid.SimpleFocusListWalker(lst)
         super().__init__(body)
 
@@ -142,7 +488,7 @@ class DirectoryListBox(urwid.ListBox):
 
 
 class FileArranger:
-    def __init__(self, files):
+    def __init__(self, files, sortkeys=None, preview=None):
         self.status = True
         self.original = files
         self.palette = [
@@ -151,20 +497,28 @@ class FileArranger:
             ("green button", "dark green, bold", "black"),
             ("red button", "dark red, bold", "black"),
             ("reversed", "standout", ""),
+            ("marked", "dark green, bold", ""),
+            ("preview ok", "dark green", ""),
+            ("preview none", "dark gray", ""),
+            ("preview error", "dark red", ""),
         ]
         header_cols = urwid.Columns([
             ("weight", 5, urwid.Text(version)),
             ("weight", 7, urwid.Text(u"manual file reorder"))
         ])
 
-        self.body = DirectoryListBox(files)
+        self.body = DirectoryListBox(files, sortkeys, preview)
         self.header = urwid.Pile([
             urwid.AttrMap(urwid.Padding(header_cols, left=2), "titlebar"),
             urwid.AttrMap(urwid.Divider(), "titlebar-divide")
         ])
         self.footer = urwid.Text([
             ("green button", u"ENTER"), u":edit/reorder files  ",
+            ("green button", u"SPACE"), u":select range  ",
+            ("green button", u"(n/m/s)"), u":sort by name/time/size  ",
             ("red button", u"ESC"), u":stop editing current directory  ",
+            ("green button", u"(u)"), u":undo  ",
+            ("green button", u"(ctrl r)"), u":redo  ",
             ("green button", u"(r)"), u":reset  ",
             ("red button", u"(q)"), u":save and quit  ",
             ("red button", u"(c)"), u":abort batchren  ",
@@ -177,7 +531,7 @@ class FileArranger:
     def unhandled_input(self, key):
         if key in ("r", "R"):
             # send a signal to reset file order
-            pass
+            self.body.reset()
         elif key in ("c", "C"):
             # send a signal to abort batchren
             self.status = False
@@ -204,6 +558,6 @@ class FileArranger:
             return None
 
 
-def main(files):
-    tui = FileArranger(files)
+def main(files, sortkeys=None, preview=None):
+    tui = FileArranger(files, sortkeys, preview)
     return tui.main()
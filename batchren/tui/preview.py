@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import os
+
+from batchren import renamer, scanner, StringSeq
+
+NO_ERRORS = frozenset()
+
+
+class PreviewPlanner:
+    """Dests and conflicts of files for a live preview.\n
+    Files are planned one directory at a time, the first time a file of
+    the directory is looked up. Including, excluding or reordering files
+    only marks their directory to be planned again, so a change runs
+    the filters and conflict checks of that directory and no other.
+    Files start included if included is True.\n
+    Sequences restart at each run of files from the same directory.
+    Excluding every file of a run can join the runs around it, so their
+    directory is planned again too.
+    """
+    def __init__(self, files, filters, ext=None, raw=False, cache=None, included=True):
+        if not isinstance(filters, renamer.FilterPipeline):
+            filters = renamer.FilterPipeline(filters)
+        self.files = files
+        self.filters = filters.compile()
+        self.ext = ext
+        self.raw = raw
+        self.cache = cache if cache is not None else scanner.DirCache()
+        # without sequences a dest doesn't depend on its position
+        self.positional = any(isinstance(f, StringSeq.StringSequence) for f in filters)
+
+        self.included = bytearray([included]) * len(files)
+        self.run_of = []
+        self.runs = []
+        self.counts = []
+        self.order = {}
+        for n, path in enumerate(files):
+            dirpath = os.path.split(path)[0]
+            if not self.runs or self.runs[-1] != dirpath:
+                self.runs.append(dirpath)
+                self.counts.append(0)
+            self.run_of.append(len(self.runs) - 1)
+            self.counts[-1] += included
+            self.order.setdefault(dirpath, []).append(n)
+
+        self.plans = {}
+        self.dests = {}
+        self.checks = {}
+        self.dirty = set(self.order)
+
+    def __len__(self):
+        return len(self.files)
+
+    def preview(self, index):
+        """Return (dest, set of issue codes) of a file, None if it's excluded """
+        dirpath = self.runs[self.run_of[index]]
+        if dirpath in self.dirty:
+            self._plan(dirpath)
+        dests, errors = self.plans[dirpath]
+        dest = dests.get(index)
+        if dest is None:
+            return None
+        return dest, errors.get(index, NO_ERRORS)
+
+    def include(self, index, state):
+        """Include or exclude a file from renaming """
+        if bool(self.included[index]) == state:
+            return
+        self.included[index] = state
+        run = self.run_of[index]
+        self.counts[run] += 1 if state else -1
+        self.dirty.add(self.runs[run])
+        self.checks.pop(self.runs[run], None)
+        if self.counts[run] == (1 if state else 0):
+            # the run appeared or disappeared between its neighbours
+            self.dirty.update(self.runs[r] for r in self._neighbours(run))
+
+    def include_all(self, state):
+        self.included = bytearray([state]) * len(self.files)
+        self.counts = [0] * len(self.runs)
+        if state:
+            for run in self.run_of:
+                self.counts[run] += 1
+        self.dirty.update(self.order)
+        self.checks.clear()
+
+    def reorder(self, dirpath, indices):
+        """Set the order of files in a directory with only one run """
+        self.order[dirpath] = list(indices)
+        self.dirty.add(dirpath)
+
+    def _neighbours(self, run):
+        """Return nearest runs before and after run with included files """
+        res = []
+        for runs in (range(run - 1, -1, -1), range(run + 1, len(self.runs))):
+            res.extend(next(([r] for r in runs if self.counts[r]), []))
+        return res
+
+    def _joined(self, prev, run):
+        """Return True if no included files are between two runs """
+        return prev == run or not any(self.counts[r] for r in range(prev + 1, run))
+
+    def _plan(self, dirpath):
+        files, run_of, memo = self.files, self.run_of, self.dests
+        indices = [n for n in self.order[dirpath] if self.included[n]]
+        srcs = [files[n] for n in indices]
+        dests = []
+        prev = None
+        file_index = 0
+        for n in indices:
+            run = run_of[n]
+            if run == prev or (prev is not None and self._joined(prev, run)):
+                file_index += 1
+            else:
+                file_index = 0
+            prev = run
+            key = (n, file_index) if self.positional else n
+            dest = memo.get(key)
+            if dest is None:
+                dest = memo[key] = renamer.runfilters(
+                    files[n], self.filters, self.ext, self.raw, (run, file_index))
+            dests.append(dest)
+
+        checks = self.checks.setdefault(dirpath, {})
+
+        def check(src, dest, fileset, cache):
+            # errors only change with the files included, not their order
+            errors = checks.get((src, dest))
+            if errors is None:
+                errors = checks[src, dest] = renamer.rename_errors(src, dest, fileset, cache)
+            # sets of conflicts are changed by generate_rentable
+            return set(errors) if errors else errors
+
+        rentable = renamer.generate_rentable(srcs, dests, self.cache, check)
+        errors = {}
+        positions = dict(zip(srcs, indices)) if rentable["conflicts"] else None
+        for obj in rentable["conflicts"].values():
+            for src in obj["srcs"]:
+                errors.setdefault(positions[src], set()).update(obj["err"])
+        self.plans[dirpath] = (dict(zip(indices, dests)), errors)
+        self.dirty.discard(dirpath)
+
+
+def preview_markup(planner, index):
+    """Return text markup of a file's new name for a preview column """
+    res = planner.preview(index)
+    if res is None:
+        return ("preview none", u"")
+    dest, errors = res
+    name = os.path.basename(dest)
+    if not errors:
+        return ("preview ok", name)
+    if errors == {0}:
+        return ("preview none", name)
+    issues = ", ".join(renamer.issues[e] for e in sorted(errors))
+    return [("preview error", name), u"  ({})".format(issues)]
@@ -1,31 +1,223 @@
 #!/usr/bin/env python3
+import fnmatch
+import operator
+import re
+from collections import OrderedDict
+from itertools import compress, repeat
+
 import urwid
 
 from batchren._version import __version__
+from batchren.tui.preview import preview_markup
 
 version = "batchren " + __version__
 
 
-def create_checkbox(text):
-    box = urwid.Padding(urwid.CheckBox(text), left=2)
+def create_checkbox(text, state=False, on_state_change=None, user_data=None, preview=None):
+    checkbox = urwid.CheckBox(text, state, on_state_change=on_state_change, user_data=user_data)
+    box = urwid.Padding(checkbox, left=2)
+    if preview is not None:
+        # new name in a column next to the file
+        box = urwid.Columns([box, urwid.Text(preview)], dividechars=2)
     return urwid.AttrMap(box, "buttn", "buttnf")
 
 
-class FileListBox(urwid.ListBox):
+class Selection:
+    """Compact bitset of selected files.\n
+    A set bit means the file's state differs from default, so selecting
+    or unselecting every file only changes default and clears the bits.
+    """
+    def __init__(self, size, default=False):
+        self.size = size
+        self.default = default
+        self.bits = bytearray((size + 7) // 8)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.default != bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def __setitem__(self, index, state):
+        mask = 1 << (index & 7)
+        if state != self.default:
+            self.bits[index >> 3] |= mask
+        else:
+            self.bits[index >> 3] &= ~mask
+
+    def set_all(self, state):
+        self.default = state
+        self.bits = bytearray(len(self.bits))
+
+
+class FileIndex:
+    """Lowercase index of files for searching.\n
+    A query is a regex if it starts with 're:', a glob if it has any
+    of '*?[' and a substring otherwise. A substring that contains the
+    previous one only looks through the previous matches.
+    """
     def __init__(self, files):
-        super().__init__([create_checkbox(f) for f in files])
+        self.names = [f.lower() for f in files]
+        self.query = ""
+        self.matches = None
+
+    def search(self, query):
+        """Return indices of files matching query, None if query is empty.\n
+        Raise re.error if a regex is invalid.
+        """
+        if not query:
+            matches = None
+        elif query.startswith("re:"):
+            pattern = query[3:]
+            # the index is lowercase, ignore case only when needed
+            flags = re.IGNORECASE if pattern != pattern.lower() else 0
+            matches = self._filter(re.compile(pattern, flags).search)
+        elif not _is_substring(query):
+            matches = self._glob(query.lower())
+        else:
+            query = query.lower()
+            if self.matches is not None and self.query and _is_substring(self.query) \
+                    and self.query in query:
+                names = self.names
+                matches = [n for n in self.matches if query in names[n]]
+            else:
+                matches = list(compress(range(len(self.names)),
+                                        map(operator.contains, self.names, repeat(query))))
+        self.query = query
+        self.matches = matches
+        return matches
+
+    def _glob(self, pattern):
+        """Return indices of files matching a glob on the whole path.\n
+        Leading stars are left to re.search, which is much faster
+        than the '.*' fnmatch would put in front.
+        """
+        stripped = pattern.lstrip("*")
+        core = stripped.rstrip("*")
+        if not any(c in core for c in "*?["):
+            # stars only at the ends, e.g. '*.txt' or 'img_*'
+            if core != stripped:
+                match = operator.contains if stripped != pattern else str.startswith
+            else:
+                match = str.endswith
+            return self._filter(match, repeat(core))
+        regex = re.compile(fnmatch.translate(stripped))
+        return self._filter(regex.search if stripped != pattern else regex.match)
+
+    def _filter(self, match, *args):
+        return list(compress(range(len(self.names)), map(match, self.names, *args)))
+
+
+def _is_substring(query):
+    return not query.startswith("re:") and not any(c in query for c in "*?[")
+
+
+class FileWalker(urwid.ListWalker):
+    """List walker that makes checkboxes only for rows being shown.\n
+    States are kept in a Selection. Widgets are cached while they are
+    recently shown, and rebuilt from the selection otherwise.
+    If rows is set, only those files are shown.\n
+    If planner is a preview.PreviewPlanner, new names are shown next
+    to files and replanned as files are selected.
+    """
+    def __init__(self, files, cache_size=256, planner=None):
+        self.files = files
+        self.planner = planner
+        self.rows = None
+        self.selection = Selection(len(files))
+        self.widgets = OrderedDict()
+        self.cache_size = cache_size
+        self.focus = 0
+
+    def __len__(self):
+        return len(self.files) if self.rows is None else len(self.rows)
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        index = position if self.rows is None else self.rows[position]
+        widget = self.widgets.get(index)
+        if widget is not None:
+            self.widgets.move_to_end(index)
+            return widget
+        preview = None if self.planner is None else preview_markup(self.planner, index)
+        widget = create_checkbox(self.files[index], self.selection[index],
+                                 self._state_changed, index, preview)
+        self.widgets[index] = widget
+        if len(self.widgets) > self.cache_size:
+            self.widgets.popitem(last=False)
+        return widget
+
+    def _state_changed(self, checkbox, state, index):
+        self.selection[index] = state
+        if self.planner is not None:
+            # names in the directory may change, remake shown rows
+            self.planner.include(index, state)
+            self.widgets.clear()
+            self._modified()
+
+    def set_rows(self, rows):
+        """Show only files at indices in rows, or every file if None """
+        self.rows = rows
+        self.focus = 0
+        self._modified()
+
+    def next_position(self, position):
+        if position + 1 >= len(self):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self) - 1, -1, -1)
+        return range(len(self))
+
+    def set_all(self, state):
+        """Set state of every file shown, cached widgets are dropped """
+        if self.rows is None:
+            self.selection.set_all(state)
+            if self.planner is not None:
+                self.planner.include_all(state)
+            self.widgets.clear()
+        elif self.planner is not None:
+            for index in self.rows:
+                self.selection[index] = state
+                self.planner.include(index, state)
+            self.widgets.clear()
+        else:
+            for index in self.rows:
+                self.selection[index] = state
+                widget = self.widgets.get(index)
+                if widget is not None:
+                    widget.base_widget.set_state(state, do_callback=False)
+        self._modified()
+
+
+class FileListBox(urwid.ListBox):
+    def __init__(self, files, planner=None):
+        super().__init__(FileWalker(files, planner=planner))
 
     def get_selected(self):
-        return [item.base_widget.label for item in self.body if item.base_widget.state]
+        selection = self.body.selection
+        return [f for n, f in enumerate(self.body.files) if selection[n]]
 
     def toggle_all(self, state):
-        for item in self.body:
-            item.base_widget.set_state(state)
-        self.focus_position = 0
+        self.body.set_all(state)
+        if len(self.body):
+            self.focus_position = 0
 
 
 class FileSelector:
-    def __init__(self, files):
+    def __init__(self, files, preview=None):
         self.status = True
         self.palette = [
             ("titlebar", "black", "light gray"),
@@ -37,29 +229,81 @@ class FileSelector:
             ("reversed", "standout", ""),
             ("buttn", "light gray", "black"),
             ("buttnf", "light gray", "black", "bold"),
+            ("preview ok", "dark green", "black"),
+            ("preview none", "dark gray", "black"),
+            ("preview error", "dark red", "black"),
         ]
         header_cols = urwid.Columns([
             ("weight", 5, urwid.Text(version)),
             ("weight", 7, urwid.Text(u"manual file selection"))
         ])
 
-        self.body = FileListBox(files)
+        # nothing is selected yet, so nothing would be renamed
+        planner = preview(files, included=False) if preview is not None else None
+        self.body = FileListBox(files, planner)
+        self.index = None
+        self.search = urwid.Edit(u"/")
+        urwid.connect_signal(self.search, "postchange", self.search_changed)
         self.header = urwid.Pile([
             urwid.AttrMap(urwid.Padding(header_cols, left=2), "titlebar"),
             urwid.AttrMap(urwid.Divider(), "titlebar-divide")
         ])
-        self.footer = urwid.Text([
+        self.buttons = urwid.Text([
             ("select button", u"(a)"), u":select all  ",
             ("reset button", u"(r)"), u":unselect all  ",
+            ("select button", u"(/)"), u":search  ",
             ("quit button", u"(q)"), u":save and quit  ",
             ("abort button", u"(c)"), u":abort batchren  ",
         ])
+        self.status_line = urwid.Text(u"")
+        self.footer = urwid.Pile([self.buttons])
         self.view = urwid.Frame(header=self.header,
             body=self.body,
             footer=self.footer)
 
+    def search_changed(self, edit, old_text):
+        """Narrow file list to files matching the search text """
+        if self.index is None:
+            self.index = FileIndex(self.body.body.files)
+        try:
+            rows = self.index.search(edit.edit_text)
+        except re.error as err:
+            # keep the last good results while the regex is being typed
+            self.status_line.set_text(u"invalid regex: {}".format(err))
+            return
+        self.body.body.set_rows(rows)
+        if rows is None:
+            self.status_line.set_text(u"")
+        else:
+            self.status_line.set_text(u"{} of {} files match".format(
+                len(rows), len(self.body.body.files)))
+
+    def open_search(self):
+        self.footer.contents[:] = [(self.search, ("pack", None)),
+                                   (self.status_line, ("pack", None))]
+        self.footer.focus_position = 0
+        self.view.focus_position = "footer"
+
+    def close_search(self, keep):
+        """Return to the file list, clear the filter unless keep is True """
+        if not keep:
+            self.search.set_edit_text(u"")
+        self.view.focus_position = "body"
+        self.footer.contents[:] = [(self.buttons, ("pack", None))]
+        if self.search.edit_text:
+            self.footer.contents.append((self.status_line, ("pack", None)))
+
     def unhandled_input(self, key):
-        if key in ("a", "A"):
+        if self.view.focus_position == "footer":
+            if key == "enter":
+                self.close_search(True)
+            elif key == "esc":
+                self.close_search(False)
+        elif key == "/":
+            self.open_search()
+        elif key == "esc":
+            self.close_search(False)
+        elif key in ("a", "A"):
             # send a signal to select all files
             self.body.toggle_all(True)
         elif key in ("r", "R"):
@@ -91,8 +335,8 @@ class FileSelector:
             return None
 
 
-def main(files):
-    tui = FileSelector(files)
+def main(files, preview=None):
+    tui = FileSelector(files, preview)
     return tui.main()
 
 
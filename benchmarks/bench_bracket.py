@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Microbenchmark bracket removal on long, bracket heavy filenames.
+
+Compares the old bracket_remove (stacks, sorted and folded indices,
+then a del per span) against the single pass helper.bracket_remove.
+
+usage: python -m benchmarks.bench_bracket [number of files]
+"""
+import random
+import sys
+import timeit
+
+from batchren import helper
+
+GROUPS = ["[SubGroup]", "[Fansub-Team]", "[HorribleRip]"]
+TAGS = ["(BD 1080p HEVC 10-bit FLAC)", "[Dual Audio]", "(Remux)", "{v2}", "[WEB-DL 720p AAC]"]
+TITLES = ["Show Name", "Another Long Series Title - The Movie", "Some Show S02"]
+
+
+def legacy_remove(expression, open_map, close_map, count):
+    """bracket_remove as it was before the single pass version """
+    stack = {"round": [], "square": [], "curly": []}
+    indices = []
+    for index, char in enumerate(expression):
+        if char in open_map:
+            stack[open_map[char]].append(index)
+        elif char in close_map:
+            if not stack[close_map[char]]:
+                indices.append((index, index))
+                continue
+            i = stack[close_map[char]].pop()
+            indices.append((i, index))
+    for k, v in stack.items():
+        for vi in v:
+            indices.append((vi, vi))
+    if not indices:
+        return expression
+
+    indices = sorted(indices, key=lambda x: x[0])
+    if not count:
+        indices = legacy_fold(indices)
+    s = list(expression)
+    cur = len(indices)
+    while indices:
+        start, end = indices.pop()
+        if not count:
+            del s[start:end + 1]
+        elif cur == count:
+            if start != end:
+                del s[start:end + 1]
+        cur -= 1
+    return "".join(s)
+
+
+def legacy_fold(indices):
+    min_start, max_end = indices[0]
+    remove_indices = [indices[0]]
+    for start, end in indices[1:]:
+        if start > max_end:
+            remove_indices.append((start, end))
+            min_start, max_end = start, end
+        elif end > max_end:
+            remove_indices[-1] = (min_start, end)
+            max_end = end
+    return remove_indices
+
+
+def release_name(rng, tags=3):
+    """Return a release name like '[Group] Title - 01 (tags) [CRC32].mkv' """
+    return "{} {} - {:02} {} [{:08X}].mkv".format(
+        rng.choice(GROUPS), rng.choice(TITLES), rng.randrange(100),
+        " ".join(rng.choice(TAGS) for _ in range(tags)), rng.getrandbits(32))
+
+
+def timed(label, func, nfiles):
+    elapsed = min(timeit.repeat(func, number=1, repeat=5))
+    print("{:<24}{:>10.3f}s{:>10.3f}us/file".format(label, elapsed, elapsed / nfiles * 1e6))
+
+
+def main(nfiles=20000):
+    rng = random.Random(0)
+    maps = helper.bracket_map("a")
+    table = helper.bracket_table(*maps)
+    # typical names, then names with hundreds of brackets
+    for tags, n in ((3, nfiles), (50, nfiles // 10), (1000, nfiles // 200)):
+        names = [release_name(rng, tags) for _ in range(n)]
+        print("{} chars per name".format(sum(map(len, names)) // n))
+        for count in (0, 3):
+            assert [helper.bracket_remove(x, *maps, count, table) for x in names] == \
+                [legacy_remove(x, *maps, count) for x in names]
+            timed("  legacy count={}".format(count),
+                  lambda: [legacy_remove(x, *maps, count) for x in names], n)
+            timed("  single pass count={}".format(count),
+                  lambda: [helper.bracket_remove(x, *maps, count, table) for x in names], n)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Microbenchmark the per-file cost of applying filters.
+
+Compares the old runfilters loop (isinstance check and try/except for
+every filter) against the compiled FilterPipeline from initfilters.
+
+usage: python -m benchmarks.bench_filters [number of files]
+"""
+import re
+import sys
+import timeit
+
+from batchren import bren, renamer, StringSeq
+
+ARGS = ["-sp", "-tr", "ab", "cd", "-c", "lower", "-pre", "x_", "-post", "_y"]
+
+
+def legacy_filters(args):
+    """Filters as the old initfilters built them """
+    filters = []
+    translmap = str.maketrans(*args.translate)
+    filters.append(lambda x: x.translate(translmap))
+    filters.append(lambda x: re.sub(r"\s+", args.spaces, x))
+    filters.append(lambda x: x.lower())
+    filters.append(lambda x: args.prepend + x)
+    filters.append(lambda x: x + args.postpend)
+    return filters
+
+
+def legacy_apply(path, dirpath, bname, filters):
+    """Filter loop of the old runfilters """
+    for runf in filters:
+        try:
+            if isinstance(runf, StringSeq.StringSequence):
+                bname = runf(path, dirpath, bname)
+            else:
+                bname = runf(bname)
+        except Exception as exc:
+            sys.exit(str(exc))
+    return bname
+
+
+def timed(label, func, nfiles):
+    elapsed = min(timeit.repeat(func, number=1, repeat=5))
+    print("{:<20}{:>10.3f}s{:>10.3f}us/file".format(label, elapsed, elapsed / nfiles * 1e6))
+
+
+def main(nfiles=100000):
+    args = bren.parser.parse_args(ARGS)
+    parts = [renamer.partfile("dir/Some File {} ab.mkv".format(i)) for i in range(nfiles)]
+
+    old = legacy_filters(args)
+    new = renamer.initfilters(args)
+    expected = [legacy_apply("", d, b, old) for d, b, e in parts]
+    assert [new("", d, b) for d, b, e in parts] == expected
+
+    timed("lambda chain", lambda: [legacy_apply("", d, b, old) for d, b, e in parts], nfiles)
+    timed("FilterPipeline", lambda: [new("", d, b) for d, b, e in parts], nfiles)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
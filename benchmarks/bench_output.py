@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Benchmark printing a large rename table.
+
+Compares a print call per line (the old print_rentable) against
+print_rentable, which writes in chunks, with and without --summary
+and --stream. Output goes to os.devnull.
+
+usage: python -m benchmarks.bench_output [number of files]
+"""
+import contextlib
+import os
+import sys
+import time
+
+from batchren import helper, renamer
+
+
+def legacy_print(rentable, sortkeys):
+    """Rename section of the old print_rentable """
+    print("{:-^30}".format(helper.BOLD + "rename" + helper.END))
+    renames = sorted(rentable["renames"].items(), key=lambda x: sortkeys[x[1]])
+    print("the following files can be renamed:")
+    for dest, src in renames:
+        print("'{}' rename to '{}'".format(src, dest))
+    print()
+    return [(r[1], r[0]) for r in renames]
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    print("{:<28}{:>10.3f}s".format(label, elapsed), file=sys.stderr)
+
+
+def main(nfiles=200000):
+    rentable = {
+        "renames": {"dir/file_{}.txt".format(i): "dir/file {}.txt".format(i) for i in range(nfiles)},
+        "conflicts": {},
+        "unresolvable": set()
+    }
+    sortkeys = helper.SortKeys()
+    sortkeys.sort(rentable["renames"].values())
+
+    with open(os.devnull, "w") as out, contextlib.redirect_stdout(out):
+        timed("print per line", legacy_print, rentable, sortkeys)
+        timed("print_rentable", renamer.print_rentable, rentable, False, False, sortkeys)
+        timed("print_rentable --stream", renamer.print_rentable, rentable, False, False, sortkeys, None, True)
+        timed("print_rentable --summary", renamer.print_rentable, rentable, False, False, sortkeys, 10)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Benchmark file discovery on a synthetic deep tree.
+
+Compares glob.iglob + os.path.isfile (the old glob_files) against
+scanner.scan_files with and without a thread pool.
+
+usage: python -m benchmarks.bench_scan [depth] [width] [files per dir]
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+from batchren import scanner
+
+
+def make_tree(root, depth, width, nfiles):
+    """Create width**depth directories, each holding nfiles files """
+    count = 0
+    level = [root]
+    for _ in range(depth):
+        nextlevel = []
+        for d in level:
+            for i in range(width):
+                sub = os.path.join(d, "dir{}".format(i))
+                os.mkdir(sub)
+                nextlevel.append(sub)
+        level = nextlevel
+    for d in level:
+        for i in range(nfiles):
+            open(os.path.join(d, "file{}.txt".format(i)), "w").close()
+            count += 1
+    return count
+
+
+def old_glob(pattern):
+    return [f for f in glob.iglob(pattern, recursive=True) if os.path.isfile(f)]
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    res = func(*args)
+    elapsed = time.perf_counter() - start
+    print("{:<28}{:>10.3f}s{:>10} files".format(label, elapsed, len(res)))
+    return res
+
+
+def main(depth=4, width=6, nfiles=10):
+    with tempfile.TemporaryDirectory() as root:
+        count = make_tree(root, depth, width, nfiles)
+        print("tree: depth={} width={} files={}".format(depth, width, count))
+        cwd = os.getcwd()
+        os.chdir(root)
+        try:
+            expected = sorted(timed("glob.iglob + isfile", old_glob, "**/*"))
+            for jobs in (1, 4, 16):
+                res = timed("scan_files jobs={}".format(jobs),
+                    lambda p, j: list(scanner.scan_files(p, j)), "**/*", jobs)
+                assert sorted(res) == expected
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:4]])
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""Benchmark interpreter startup for the batchren command.
+
+Reports the cumulative import time of batchren.bren from
+python -X importtime and the wall time of 'batchren --version'.
+
+usage: python -m benchmarks.bench_startup [runs]
+"""
+import subprocess
+import sys
+import time
+
+
+def import_time(module):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in proc.stderr.splitlines():
+        if line.count("|") != 2:
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1e6
+    return 0.0
+
+
+def wall_time(args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def main(runs=10):
+    imports = min(import_time("batchren.bren") for _ in range(runs))
+    main_cmd = ["-c", "from batchren import bren; bren.main()", "--version"]
+    version = min(wall_time(main_cmd) for _ in range(runs))
+    print("{:<28}{:>10.3f}s".format("import batchren.bren", imports))
+    print("{:<28}{:>10.3f}s".format("batchren --version", version))
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
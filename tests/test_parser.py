@@ -1,21 +1,28 @@
 #!/usr/bin/env python3
 import argparse
+import glob
 import os
+import subprocess
+import sys
 
 import pytest
 
-from batchren import bren, helper
+from batchren import bren, helper, scanner
 parser = bren.parser
 
 """Tests for batchren.bren written with pytest.
 
 Performs tests for the following:
 - check_optional
+- scan_files
 - expand_dir
 - validate_ext
 - validate_esc
+- validate_jobs (jobs, procs, parallel renames)
 - parser arguments
 - parser custom actions
+- recover action
+- startup imports
 
 pytest: http://doc.pytest.org/en/latest/contents.html
 
@@ -93,6 +100,35 @@ def test_parser_glob(directory, glob_pattern, glob_files):
     assert files == glob_files
 
 
+@pytest.mark.parametrize("scan_pattern", [
+    "*", "**", "**/*", "**/file[a]", "dir/**", "dir/**/*", "*/file?",
+    "dir/", "dir/filea", "dir/nofile", ".*", "**/.*", "dir/file[[]*]"
+])
+def test_scan_files(directory, scan_pattern):
+    """Test that scandir discovery matches glob, including hidden files """
+    os.chdir(directory)
+    (directory / "dir" / ".hidden").write_text("hidden")
+    (directory / "dir" / "file[*]").write_text("escaped")
+    expected = [f for f in glob.iglob(scan_pattern, recursive=True) if os.path.isfile(f)]
+    files = list(scanner.scan_files(scan_pattern))
+    assert sorted(files) == sorted(expected)
+
+
+@pytest.mark.parametrize("scan_pattern", ["**", "**/*", "**/file[a]", "dir/**/*"])
+def test_scan_files_jobs(directory, scan_pattern):
+    """Test that threaded discovery finds the same files in the same order """
+    os.chdir(directory)
+    files = bren.glob_files(scan_pattern)
+    assert bren.glob_files(scan_pattern, jobs=4) == files
+
+
+@pytest.mark.parametrize("jobs_errarg", ["0", "-1", "a", "1.5", ""])
+def test_validate_jobs_err(jobs_errarg):
+    """Validate jobs argument is a positive integer """
+    with pytest.raises(argparse.ArgumentTypeError) as err:
+        jobs = bren.validate_jobs(jobs_errarg)
+
+
 def test_parser_defaults():
     """Test the defaults of each option without arguments """
     args = parser.parse_args([])
@@ -106,6 +142,17 @@ def test_parser_defaults():
     assert args.raw is False
     assert args.sel is False
     assert args.sort == "asc"
+    assert args.jobs == 1
+    assert args.procs == 1
+    assert args.parallel_renames == 1
+    assert args.journal is None
+    assert args.recover is None
+    assert args.summary is None
+    assert args.stream is False
+    assert args.plan_out is None
+    assert args.plan_in is None
+    assert args.cache is None
+    assert args.preview is False
     assert args.prepend is None
     assert args.postpend is None
     assert args.bracket_remove is None
@@ -145,6 +192,16 @@ def test_parser_defaults():
     (["dir", "--raw", "-q"], False),
     (["dir", "--sort", "man"], False),
     (["dir", "--sel"], False),
+    (["dir", "--jobs", "4"], False),
+    (["dir", "--procs", "4"], False),
+    (["dir", "--parallel-renames", "4"], False),
+    (["dir", "--journal", "file"], False),
+    (["dir", "--summary"], False),
+    (["dir", "--stream"], False),
+    (["dir", "--plan-out", "file"], False),
+    (["dir", "--cache", "file"], False),
+    (["dir", "--sel", "--preview"], False),
+    (["dir", "--sort", "man", "--preview", "-pre", "bla"], True),
 ])
 def test_check_optional(opt_arg, opt_res):
     """Test which arguments must have accompanying effects
@@ -301,7 +358,15 @@ def test_parser_shave_err(sh_errarg):
         assert err.type == SystemExit
 
 
-# tests for reg_arg, reg_res
+@pytest.mark.parametrize("reg_arg, reg_res", [
+    (["-re", "a"], [("a", "", 0)]),
+    (["-re", "a", "b", "2"], [("a", "b", 2)]),
+    (["-re", "a", "-re", "[0-9]+", "#"], [("a", "", 0), ("[0-9]+", "#", 0)]),
+])
+def test_parser_regex(reg_arg, reg_res):
+    """Test that regex arguments are kept in order of appearance """
+    args = parser.parse_args(reg_arg)
+    assert [(p.pattern, repl, count) for p, repl, count in args.regex] == reg_res
 
 
 @pytest.mark.parametrize("reg_errarg", [
@@ -386,3 +451,65 @@ def test_parser_sequence_err(seq_errarg):
         args = parser.parse_args(["-seq", *seq_errarg])
         print(seq_errarg, "is errorneous")
         assert err.type == SystemExit
+
+
+@pytest.mark.parametrize("sum_arg, sum_res", [
+    (["--summary"], 10),
+    (["--summary", "3"], 3),
+])
+def test_parser_summary(sum_arg, sum_res):
+    """Test summary argument defaults to 10 files """
+    args = parser.parse_args(sum_arg)
+    assert args.summary == sum_res
+
+
+@pytest.mark.parametrize("rec_arg, rec_res", [
+    ([], "forward"),
+    (["forward"], "forward"),
+    (["rollback"], "rollback"),
+])
+def test_parser_recover(tmp_path, rec_arg, rec_res):
+    """Test recover argument returns journal and mode """
+    path = tmp_path / "journal"
+    path.write_text("")
+    args = parser.parse_args(["--recover", str(path), *rec_arg])
+    assert args.recover == (str(path), rec_res)
+
+
+@pytest.mark.parametrize("rec_errarg", [
+    (["missing"]),
+    (["journal", "backward"]),
+    (["journal", "forward", "rollback"]),
+])
+def test_parser_recover_err(tmp_path, rec_errarg):
+    """Test recover argument errors
+    Raise error if journal doesn't exist, mode is unknown or too many arguments
+    """
+    (tmp_path / "journal").write_text("")
+    os.chdir(tmp_path)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--recover", *rec_errarg])
+
+
+def import_times(module):
+    """Return dict of module to cumulative import time (us) from python -X importtime """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(bren.__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                          env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("heavy", ["urwid", "natsort", "concurrent.futures", "multiprocessing"])
+def test_startup_imports(heavy):
+    """Test that heavy modules are only imported by the code paths using them """
+    times = import_times("batchren.bren")
+    assert "batchren.bren" in times
+    assert heavy not in times
@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
+import io
+import json
 import os
+import random
+import re
+import time
+from datetime import datetime
 
 import pytest
+from natsort import natsorted, ns
 
-from batchren import bren, renamer
+from batchren import bren, cache, helper, journal, plan, renamer, scanner, StringSeq
 from tests.data import file_dirs
 parser = bren.parser
 
@@ -13,8 +20,16 @@ Performs tests for the following:
 - partfile
 - joinparts
 - optional arguments
+- filter pipeline
 - conflict resolution
 - cycle renaming
+- parallel renaming
+- journal recovery
+- directory cache
+- sort key cache
+- rename table output
+- plan export and import
+- persistent plan cache
 
 Some tests utilize the tmp_path_factory fixture, which is a pathlib2 object.
 Details here: https://docs.python.org/3/library/pathlib.html
@@ -331,6 +346,76 @@ def test_filter_regex(re_arg, re_src, re_dest):
     assert dest == re_dest
 
 
+@pytest.mark.parametrize("re_arg, re_src, re_dest", [
+    (["-re", "a", "-re", "b"], ["cabbage"], ["cge"]),
+    (["-re", "b", "-re", "ac"], ["abc"], [""]),
+    (["-re", "\\d", "-re", "[ _]", "-re", "x", "y"], ["1 x_2 y3"], ["yy"]),
+    (["-re", "[0-9]+", "#", "-re", "#", "", "2"], ["1 2 3"], ["#  #"]),
+])
+def test_filter_regex_chain(re_arg, re_src, re_dest):
+    """Test that repeated regex arguments are applied in order """
+    args = parser.parse_args(re_arg)
+    filters = renamer.initfilters(args)
+    dest = renamer.get_renames(re_src, filters, args.extension, args.raw)
+    assert dest == re_dest
+
+
+def test_filter_regex_merge():
+    """Test that single character removals are merged into one pass """
+    regexes = [(re.compile(p), repl, count) for p, repl, count in [
+        ("[0-9]", "", 0), ("_", "", 0), (".", "", 2), ("x|y", "", 0), ("(?i)A", "", 0),
+        ("a", "", 0), ("ab", "", 0), ("\\s", "", 0), ("[^q]", "", 0)]]
+    filters = renamer.regex_filters(regexes)
+    assert [f.pattern.pattern for f in filters] == [
+        "(?:[0-9])|(?:_)", ".", "x|y", "(?i)A", "a", "ab", "(?:\\s)|(?:[^q])"]
+
+    rng = random.Random(0)
+    names = ["".join(rng.choice("0a_xAb q9") for _ in range(rng.randrange(15))) for _ in range(500)]
+    for name in names:
+        expected = name
+        for regex in regexes:
+            expected = renamer.RegexFilter(*regex)(expected)
+        merged = name
+        for regex in filters:
+            merged = regex(merged)
+        assert merged == expected
+
+
+def legacy_repl_nth(pattern, repl, count):
+    """nth replacement as the old _repl_decorator did it """
+    def replacer(matchobj):
+        res = repl if matchobj.group() and replacer._count == count else matchobj.group()
+        replacer._count += 1
+        return res
+
+    def repl_nth(x):
+        replacer._count = 1
+        return re.sub(pattern, replacer, x, count)
+    return repl_nth
+
+
+@pytest.mark.parametrize("pattern, repl", [
+    ("d", "x"), ("d*", "x"), ("(d)", "\\1"), ("\\b", "|"), ("i|dd", ""),
+])
+def test_filter_regex_nth(pattern, repl):
+    """Test nth replacement against the old replacer, including empty matches """
+    rng = random.Random(pattern)
+    names = ["".join(rng.choice("did ly") for _ in range(rng.randrange(12))) for _ in range(300)]
+    for count in range(1, 6):
+        regex = renamer.RegexFilter(re.compile(pattern), repl, count)
+        legacy = legacy_repl_nth(re.compile(pattern), repl, count)
+        assert [regex(n) for n in names] == [legacy(n) for n in names]
+
+
+def test_filter_regex_threads():
+    """Test that a regex filter gives the same names when shared by threads """
+    from concurrent.futures import ThreadPoolExecutor
+    regex = renamer.RegexFilter("[0-9]+", "#", 2)
+    names = ["{} file {} v{}".format(n, n * 7, n % 3) for n in range(2000)]
+    with ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(regex, names, chunksize=10)) == [regex(n) for n in names]
+
+
 @pytest.mark.parametrize("seq_arg, seq_src, seq_dest", [
     (["%f"], ["f1", "f2", "f3", "f4"], ["f1", "f2", "f3", "f4"]),
     (["%n"], ["f1", "f2", "f3", "f4"], ["01", "02", "03", "04"]),
@@ -378,6 +463,46 @@ def test_filter_sequence(seq_arg, seq_src, seq_dest):
     assert dest == seq_dest
 
 
+@pytest.mark.parametrize("seq_arg, seq_src, seq_dest", [
+    (["%n/%a"], ["d1/f1", "d1/f2", "d2/f1", "d2/f2"], ["d1/01a", "d1/02b", "d2/01a", "d2/02b"]),
+    (["%a:y:B/_/%n::2"], ["d1/f", "d1/g", "d1/h", "d2/f", "d1/i"],
+        ["d1/y_01", "d1/z_02", "d1/A_01", "d2/y_01", "d1/y_01"]),
+])
+def test_filter_sequence_dirs(seq_arg, seq_src, seq_dest):
+    """Test that every sequence restarts in each directory """
+    args = parser.parse_args(['-seq', *seq_arg])
+    filters = renamer.initfilters(args)
+    dest = renamer.get_renames(seq_src, filters, args.extension, args.raw)
+    assert dest == seq_dest
+
+
+def test_filter_sequence_unprepared():
+    """Test that sequences give the same values with and without prepare """
+    src = ["d{}/f{}".format(d, n) for d in range(3) for n in range(100 * d + 5)]
+    args = parser.parse_args(["-seq", "%f/_/%n3:5:90:3/_/%a2:b:dC"])
+    expected = renamer.get_renames(src, renamer.initfilters(args), args.extension, args.raw)
+    args = parser.parse_args(["-seq", "%f/_/%n3:5:90:3/_/%a2:b:dC"])
+    assert [renamer.runfilters(f, [args.sequence]) for f in src] == expected
+
+
+@pytest.mark.parametrize("seq_arg", [
+    ["%n/%a"], ["%n3:5:90:3/_/%a2:b:dC"], ["%a:y:B/%n::2/%f"], ["%a3:x/%n0:0:0:0"],
+])
+def test_filter_sequence_at(seq_arg):
+    """Test that sequences give the same values for positions in any order """
+    src = ["d{}/f{}".format(d % 3, n) for d in range(5) for n in range(40 * d + 3)]
+    args = parser.parse_args(["-seq", *seq_arg])
+    expected = renamer.get_renames(src, renamer.initfilters(args), args.extension, args.raw)
+
+    args = parser.parse_args(["-seq", *seq_arg])
+    order = list(enumerate(zip(src, StringSeq.positions(src))))
+    random.Random(0).shuffle(order)
+    dest = [None] * len(src)
+    for n, (path, pos) in order:
+        dest[n] = renamer.runfilters(path, [args.sequence], pos=pos)
+    assert dest == expected
+
+
 @pytest.mark.parametrize("ext_arg, ext_src, ext_dest", [
     (["-pre", "f", "-ext", ""], ["file.txt"], ["ffile"]),
     (["-pre", "f", "-ext", "mp4"], ["file.txt"], ["ffile.mp4"]),
@@ -410,6 +535,67 @@ def test_filter_raw(raw_arg, raw_src, raw_dest):
     assert dest == raw_dest
 
 
+@pytest.mark.parametrize("pipe_arg, pipe_stages, pipe_src, pipe_dest", [
+    (["-tr", "ab", "cd", "-c", "upper"], 1, ["dir/fab.txt"], ["dir/FCD.txt"]),
+    (["-sp", "-pre", "x", "-post", "y"], 1, ["a b", "c  d"], ["xa_by", "xc_dy"]),
+    (["-c", "lower", "-seq", "%f/%n", "-pre", "_"], 3, ["A", "B"], ["_a01", "_b02"]),
+    (["-seq", "%n"], 1, ["a", "b"], ["01", "02"]),
+])
+def test_filter_pipeline(pipe_arg, pipe_stages, pipe_src, pipe_dest):
+    """Test that plain filters are fused into stages around sequences """
+    args = parser.parse_args(pipe_arg)
+    filters = renamer.initfilters(args)
+    assert len(filters.stages) == pipe_stages
+    dest = renamer.get_renames(pipe_src, filters, args.extension, args.raw)
+    assert dest == pipe_dest
+
+
+def test_filter_pipeline_list():
+    """Test that a plain list of functions is still accepted """
+    filters = [str.upper, lambda x: x + "_1"]
+    dest = renamer.get_renames(["dir/file.txt"], filters, None, False)
+    assert dest == ["dir/FILE_1.txt"]
+    assert renamer.runfilters("file", filters) == "FILE_1"
+
+
+@pytest.mark.parametrize("procs_arg", [
+    ["-re", "[0-9]", "-bracr", "s", "-c", "upper"],
+    ["-bracr", "r", "-seq", "%f/_/%n", "-post", "x"],
+    ["-seq", "%a/%f", "-pre", "x"],
+    ["-sp", ".", "--raw", "-ext", "mkv"],
+])
+def test_filter_procs(procs_arg):
+    """Test that planning with a process pool gives the same names as one process """
+    args = parser.parse_args(procs_arg)
+    src = ["dir{}/[grp] file {} (x).txt".format(d, n) for d in range(3) for n in range(20)]
+    serial = renamer.get_renames(src, renamer.initfilters(args), args.extension, args.raw)
+    args = parser.parse_args(procs_arg + ["--procs", "3"])
+    dest = renamer.get_renames(src, renamer.initfilters(args), args.extension, args.raw, args.procs)
+    assert dest == serial
+
+
+def test_filter_procs_no_mp_context(monkeypatch):
+    """Test planning with a process pool that doesn't take mp_context (Python 3.6) """
+    from concurrent import futures
+    pool = futures.ProcessPoolExecutor
+    pools = []
+
+    def old_pool(max_workers=None, **kwargs):
+        if kwargs:
+            raise TypeError("__init__() got an unexpected keyword argument 'mp_context'")
+        pools.append(max_workers)
+        return pool(max_workers)
+
+    monkeypatch.setattr(futures, "ProcessPoolExecutor", old_pool)
+    args = parser.parse_args(["-bracr", "r", "-seq", "%f/_/%n", "-post", "x"])
+    src = ["dir{}/[grp] file {} (x).txt".format(d, n) for d in range(3) for n in range(20)]
+    serial = renamer.get_renames(src, renamer.initfilters(args), args.extension, args.raw)
+    dest = renamer.get_renames(src, renamer.initfilters(args), args.extension, args.raw, 3)
+    assert dest == serial
+    assert pools == [3]
+    assert renamer._worker is None
+
+
 @pytest.fixture
 def fs(tmp_path_factory):
     """Fixture for fixed tmp_path_factory """
@@ -484,6 +670,65 @@ def test_rentable_invalid(fs, src, dest):
     assert not table["renames"]
 
 
+def legacy_rentable(src_files, dest_files):
+    """Rename table built by the old cascade algorithm, used as a reference """
+    fileset = set(src_files)
+    renames, conflicts, unres = {}, {}, set()
+
+    def cascade(ndest):
+        while True:
+            unres.add(ndest)
+            if ndest not in renames:
+                return
+            tmp = renames.pop(ndest)
+            conflicts[ndest] = {"srcs": [tmp], "err": {6}}
+            ndest = tmp
+
+    for src, dest in zip(src_files, dest_files):
+        errset = set()
+        if dest in conflicts:
+            conflicts[dest]["srcs"].append(src)
+            conflicts[dest]["err"].add(6)
+            errset = conflicts[dest]["err"]
+            cascade(src)
+        elif dest in renames:
+            errset = {0, 6} if dest == src else {6}
+            conflicts[dest] = {"srcs": [renames.pop(dest), src], "err": errset}
+            for n in conflicts[dest]["srcs"]:
+                cascade(n)
+        elif dest in unres:
+            errset.add(6)
+            conflicts[dest] = {"srcs": [src], "err": errset}
+            cascade(src)
+        else:
+            errset = renamer.rename_errors(src, dest, fileset, scanner.DirCache())
+            if errset:
+                conflicts[dest] = {"srcs": [src], "err": errset}
+                cascade(src)
+        if not errset:
+            renames[dest] = src
+
+    return {"renames": renames, "conflicts": conflicts, "unresolvable": unres}
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rentable_legacy(fs, seed):
+    """Test that the rename table matches the old cascade algorithm
+    on random chains, cycles, shared names and invalid names
+    """
+    os.chdir(fs)
+    rand = random.Random(seed)
+    names = ["dir/file" + c for c in "abcdefgh"]
+    extra = ["dir/", "dir/.filea", "dir/subdir/filea", "dir/filea/"]
+    for _ in range(200):
+        src = rand.sample(names, rand.randint(1, len(names)))
+        dest = [rand.choice(extra if rand.random() < 0.1 else names) for _ in src]
+        table = renamer.generate_rentable(src, dest)
+        expected = legacy_rentable(src, dest)
+        assert table == expected
+        assert list(table["renames"].items()) == list(expected["renames"].items())
+
+
 @pytest.fixture
 def param_fs(tmp_path_factory, request):
     """Parametrized tmp_path_factory fixture """
@@ -535,6 +780,106 @@ def test_renamer_dryrun(monkeypatch, param_fs, src, dest):
         assert f.read_text() == s
 
 
+@pytest.mark.parametrize("param_fs, src, dest", [
+    (file_dirs.fs2, ["dir1/01", "dir1/02"], ["dir1/02", "dir1/01"]),
+    (file_dirs.fs2, ["dir1/01", "dir1/02", "dir1/03"], ["dir1/02", "dir1/03", "dir1/01"])],
+    indirect=["param_fs"]
+)
+def test_renamer_dryrun_cycle(param_fs, src, dest):
+    """Test that a dryrun of a rename cycle finishes without changing files """
+    os.chdir(param_fs)
+    table = renamer.generate_rentable(src, dest)
+    queue = renamer.print_rentable(table)
+    renamer.rename_queue(queue, dryrun=True)
+    for s in src:
+        f = param_fs / s
+        assert f.read_text() == s
+
+
+@pytest.mark.parametrize("queue, nsteps, nqueue", [
+    # chain, renamed from the free end
+    ([("d/a", "d/b"), ("d/b", "d/c"), ("d/c", "d/e")], 3, 5),
+    # swap and rotation, one temporary name per cycle
+    ([("d/a", "d/b"), ("d/b", "d/a")], 3, 3),
+    ([("d/a", "d/b"), ("d/b", "d/c"), ("d/c", "d/a")], 4, 5),
+    ([("d/a", "d/b"), ("d/b", "d/c"), ("d/c", "d/e"), ("d/e", "d/a")], 5, 7),
+    # chain joined from the middle, cycle next to it
+    ([("d/b", "d/c"), ("d/a", "d/b"), ("d/c", "d/e"), ("d/x", "d/y"), ("d/y", "d/x")], 6, 7),
+])
+def test_schedule_renames(queue, nsteps, nqueue):
+    """Test that scheduled renames never target a taken name and
+    that each cycle needs one temporary name
+    """
+    names = renamer.name_gen(scanner.DirCache())
+    next(names)
+    chains, temps = renamer.schedule_renames(queue, names)
+    steps = [step for chain in chains for step in chain]
+    assert len(steps) == nsteps
+    assert renamer.count_queue_renames(queue) == nqueue
+
+    taken = {src: src for src, _ in queue}
+    for src, dest in steps:
+        assert dest not in taken
+        taken[dest] = taken.pop(src)
+    assert {orig: name for name, orig in taken.items()} == dict(queue)
+    assert all(t not in taken for t in temps)
+
+
+def test_dircache(fs):
+    """Test that the directory cache answers lookups and follows renames """
+    os.chdir(fs)
+    cache = scanner.DirCache()
+    files = bren.glob_files("dir/*", cache=cache)
+    assert files == ["dir/filea", "dir/fileb", "dir/filec", "dir/filed"]
+    assert set(cache.dirs) == {"dir"}
+
+    assert cache.exists("dir/filea")
+    assert cache.exists("dir//filea")
+    assert cache.exists("./dir/subdir")
+    assert not cache.exists("dir/filez")
+    assert not cache.exists("nodir/filea")
+    assert cache.getmtime("dir/filea") == os.path.getmtime("dir/filea")
+
+    cache.rename("dir/filea", "dir/filez")
+    assert not cache.exists("dir/filea")
+    assert cache.exists("dir/filez")
+    assert os.path.exists("dir/filea")
+
+
+class StatCounter(scanner.DirCache):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def stat(self, path):
+        self.calls += 1
+        return super().stat(path)
+
+
+def test_sequence_metadata(fs):
+    """Test metadata formatters read one stat per file """
+    os.chdir(fs)
+    os.utime("dir/filea", (0, 86400 * 365))
+    st = os.stat("dir/filea")
+    args = parser.parse_args(["-seq", "%md/_/%mt/_/%sz/_/%in/_/%cd/%ct/_/%ow/_/%f"])
+    cache = StatCounter()
+    args.sequence.set_cache(cache)
+    files = bren.glob_files("dir/*", cache=cache)
+    dest = renamer.get_renames(files, renamer.initfilters(args), args.extension, args.raw)
+    assert cache.calls == len(files)
+
+    try:
+        import pwd
+        owner = pwd.getpwuid(st.st_uid).pw_name
+    except (ImportError, KeyError):
+        owner = str(st.st_uid)
+    mtime = datetime.fromtimestamp(st.st_mtime)
+    ctime = datetime.fromtimestamp(st.st_ctime)
+    assert dest[0] == "dir/{}_{}_{}_{}_{}{}_{}_filea".format(
+        mtime.strftime("%Y-%m-%d"), mtime.strftime("%H.%M.%S"), st.st_size, st.st_ino,
+        ctime.strftime("%Y-%m-%d"), ctime.strftime("%H.%M.%S"), owner)
+
+
 @pytest.mark.parametrize("param_fs, queue", [
     (file_dirs.fs1, [("dir/filea", "dir/filex"), ("dir/fileb", "dir/filey"), ("dir/filec", 10)]),
     (file_dirs.fs1, [("dir/filea", "dir/fileb"), ("dir/fileb", "dir/filey"), ("dir/filec", 10)])
@@ -547,3 +892,403 @@ def test_renamer_rollback(param_fs, queue):
             f = param_fs / src
             assert f.read_text() == src
     # assert False
+
+
+@pytest.mark.parametrize("param_fs, src, dest", [
+    (file_dirs.fs2, ["dir1/01", "dir1/02", "dir1/03", "dir2/01", "dir2/02"],
+        ["dir1/02", "dir1/03", "dir1/01", "dir2/02", "dir2/05"])],
+    indirect=["param_fs"]
+)
+def test_renamer_parallel(param_fs, src, dest):
+    """Test that files are renamed as expected with a thread pool """
+    os.chdir(param_fs)
+    table = renamer.generate_rentable(src, dest)
+    queue = renamer.print_rentable(table)
+    renamer.rename_queue(queue, jobs=4)
+    for s, d in zip(src, dest):
+        f = param_fs / d
+        assert f.read_text() == s
+
+
+@pytest.mark.parametrize("param_fs, src, dest", [
+    (file_dirs.fs2, ["dir1/01", "dir1/02", "dir1/03", "dir2/01", "dir2/02"],
+        ["dir1/02", "dir1/03", "dir1/01", "dir2/02", "dir2/05"])],
+    indirect=["param_fs"]
+)
+def test_renamer_parallel_rollback(monkeypatch, param_fs, src, dest):
+    """Test that a failed rename with a thread pool rolls back every chain """
+    os.chdir(param_fs)
+    rename_file = renamer.rename_file
+
+    def failing_rename(s, d):
+        if s == "dir2/01":
+            raise OSError("failed")
+        rename_file(s, d)
+
+    monkeypatch.setattr(renamer, "rename_file", failing_rename)
+    table = renamer.generate_rentable(src, dest)
+    queue = renamer.print_rentable(table)
+    with pytest.raises(SystemExit):
+        renamer.rename_queue(queue, jobs=4)
+    for s in src:
+        f = param_fs / s
+        assert f.read_text() == s
+    assert sorted(os.listdir("dir1")) == ["01", "02", "03"]
+
+
+@pytest.mark.parametrize("param_fs, src, dest", [
+    (file_dirs.fs2, ["dir1/01", "dir1/02", "dir1/03", "dir2/01", "dir2/02"],
+        ["dir1/02", "dir1/03", "dir1/01", "dir2/02", "dir2/05"])],
+    indirect=["param_fs"]
+)
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_journal(param_fs, src, dest, jobs):
+    """Test that the journal records the schedule and every rename """
+    os.chdir(param_fs)
+    queue = list(zip(src, dest))
+    renamer.rename_queue(queue, jobs=jobs, journal=journal.Journal("journal"))
+    cwd, chains, done, undone = journal.read("journal")
+    assert cwd == os.getcwd()
+    assert len(chains) == 2
+    assert [len(chain) for chain in chains] == [4, 2]
+    assert done == [4, 2]
+    assert not undone
+
+
+@pytest.mark.parametrize("crash", range(7))
+@pytest.mark.parametrize("mode", ["forward", "rollback"])
+@pytest.mark.parametrize("param_fs, src, dest", [
+    (file_dirs.fs2, ["dir1/01", "dir1/02", "dir1/03", "dir2/01", "dir2/02"],
+        ["dir1/02", "dir1/03", "dir1/01", "dir2/02", "dir2/05"])],
+    indirect=["param_fs"]
+)
+def test_journal_recover(monkeypatch, param_fs, src, dest, crash, mode):
+    """Test recovery after the process is killed partway through.\n
+    Only the journal written to disk before the crash is used, so
+    unsynced done records are lost and the last line is cut short.
+    """
+    os.chdir(param_fs)
+    rename_file = renamer.rename_file
+    calls = []
+
+    def killed_rename(s, d):
+        if len(calls) == crash:
+            raise KeyboardInterrupt
+        calls.append((s, d))
+        rename_file(s, d)
+
+    monkeypatch.setattr(renamer, "rename_file", killed_rename)
+    log = journal.Journal("journal")
+    try:
+        renamer.rename_queue(list(zip(src, dest)), journal=log)
+    except KeyboardInterrupt:
+        pass
+    with open("journal") as f:
+        ondisk = f.read()
+    with open("crashed", "w") as f:
+        f.write(ondisk + '{"op": "do')
+
+    journal.recover("crashed", mode)
+    expected = dest if mode == "forward" else src
+    for s, d in zip(src, expected):
+        f = param_fs / d
+        assert f.read_text() == s
+    assert sorted(os.listdir("dir1")) == ["01", "02", "03"]
+
+
+@pytest.mark.parametrize("param_fs, src, dest", [
+    (file_dirs.fs2, ["dir1/03", "dir1/02"], ["dir1/05", "dir1/03"])],
+    indirect=["param_fs"]
+)
+def test_journal_recover_relative(param_fs, src, dest):
+    """Test recovery from another directory with a relative journal path """
+    os.chdir(param_fs)
+    log = journal.Journal("journal")
+    log.plan([list(zip(src, dest))])
+    log.file.close()
+
+    os.chdir(param_fs.parent)
+    journal.recover(os.path.join(param_fs.name, "journal"), "forward")
+    assert os.getcwd() == str(param_fs)
+    for s, d in zip(src, dest):
+        assert (param_fs / d).read_text() == s
+    cwd, chains, done, undone = journal.read("journal")
+    assert done == [2]
+
+
+def test_journal_recover_nodir(tmp_path):
+    """Test that recovery exits if the journal's directory is gone """
+    path = tmp_path / "journal"
+    path.write_text(json.dumps({"op": "begin", "cwd": str(tmp_path / "gone")}) + "\n")
+    with pytest.raises(SystemExit, match="Cannot recover from journal"):
+        journal.recover(str(path))
+
+
+@pytest.mark.parametrize("paths", [
+    ["dir/file10", "dir/file2", "dir/file1", "dir2/file1", "dir/sub/file1"],
+    ["b.txt", "a10.txt", "a2.txt", "a2.tar.gz", "A1.txt", "dir/a"],
+])
+def test_sortkeys(paths):
+    """Test cached sort keys give the same order as natsorted """
+    sortkeys = helper.SortKeys()
+    assert sortkeys.sort(paths) == natsorted(paths, alg=ns.PATH)
+    assert sortkeys.sort(paths, reverse=True) == natsorted(paths, reverse=True, alg=ns.PATH)
+    assert set(sortkeys) == set(paths)
+
+
+@pytest.mark.parametrize("param_fs, src, dest", [
+    (file_dirs.fs2, ["dir1/01", "dir1/02", "dir1/03", "dir2/01", "dir2/02"],
+        ["dir1/10", "dir1/2", "dir1/03", "dir2/02", "dir2/1"])],
+    indirect=["param_fs"]
+)
+def test_rentable_sortkeys(param_fs, src, dest):
+    """Test that the rename queue is sorted by src using the shared cache """
+    os.chdir(param_fs)
+    sortkeys = helper.SortKeys()
+    files = bren.glob_files("**/*", sortkeys=sortkeys)
+    assert set(files) <= set(sortkeys)
+
+    table = renamer.generate_rentable(src, dest)
+    queue = renamer.print_rentable(table, verbose=True, sortkeys=sortkeys)
+    assert queue == renamer.print_rentable(table, verbose=True)
+    assert [s for s, d in queue] == natsorted([s for s, d in queue], alg=ns.PATH)
+
+
+def test_rentable_summary(fs):
+    """Test that summary shows counts and at most N files of each """
+    os.chdir(fs)
+    src = ["dir/filea", "dir/fileb", "dir/filec", "dir/filed"] + ["dir/x{}".format(i) for i in range(5)]
+    dest = ["dir/filec", "dir/filec", "dir/filec", "dir/.filed"] + ["dir/y{}".format(i) for i in range(5)]
+    table = renamer.generate_rentable(src, dest)
+    out = io.StringIO()
+    queue = renamer.print_rentable(table, summary=2, out=out)
+    assert queue == renamer.print_rentable(table, out=io.StringIO())
+    lines = out.getvalue().splitlines()
+    assert "4 files will NOT be renamed:" in lines
+    assert "       1 name cannot start with '.'" in lines
+    assert "       3 shared name conflict" in lines
+    assert "5 files can be renamed:" in lines
+    assert "... and 3 more" in lines
+    assert len([line for line in lines if "-->" in line]) == 2 + 1
+
+
+def test_rentable_stream(fs):
+    """Test that stream keeps the order files were found in """
+    os.chdir(fs)
+    src = ["dir/filed", "dir/filea", "dir/filec"]
+    dest = ["dir/filez", "dir/filey", "dir/filex"]
+    table = renamer.generate_rentable(src, dest)
+    out = io.StringIO()
+    queue = renamer.print_rentable(table, stream=True, out=out)
+    assert queue == list(zip(src, dest))
+    assert out.getvalue().splitlines()[2:5] == ["'{}' rename to '{}'".format(s, d) for s, d in queue]
+
+
+def test_rentable_closed_output(monkeypatch, fs):
+    """Test that nothing is renamed if output is closed while printing """
+    monkeypatch.setattr("builtins.input", lambda *args: "Y")
+    os.chdir(fs)
+    args = parser.parse_args([])
+    r, w = os.pipe()
+    os.close(r)
+    with os.fdopen(w, "w") as out:
+        monkeypatch.setattr("sys.stdout", out)
+        with pytest.raises(SystemExit, match="no files were renamed"):
+            renamer.finish_rename(["dir/filea"], ["dir/filez"], args)
+    assert os.path.exists("dir/filea")
+    assert not os.path.exists("dir/filez")
+
+
+def test_rentable_closed_prompt(monkeypatch, fs):
+    """Test that nothing is renamed if output is closed after the table
+    fits in one chunk, before the prompt is shown """
+    os.chdir(fs)
+    args = parser.parse_args(["--stream"])
+    r, w = os.pipe()
+
+    def closed_input(prompt):
+        # reader exits after reading the table, like head -n
+        os.close(r)
+        out.write(prompt)
+        out.flush()
+        return "Y"
+
+    monkeypatch.setattr("builtins.input", closed_input)
+    with os.fdopen(w, "w") as out:
+        monkeypatch.setattr("sys.stdout", out)
+        with pytest.raises(SystemExit, match="no files were renamed"):
+            renamer.finish_rename(["dir/filea"], ["dir/filez"], args)
+    assert os.path.exists("dir/filea")
+    assert not os.path.exists("dir/filez")
+
+
+@pytest.mark.parametrize("param_fs, src, dest", [
+    (file_dirs.fs2, ["dir1/01", "dir1/02", "dir1/03", "dir2/01", "dir2/02"],
+        ["dir1/02", "dir1/03", "dir1/01", "dir2/03", "dir2/.02"])],
+    indirect=["param_fs"]
+)
+def test_plan(monkeypatch, param_fs, src, dest):
+    """Test that a plan written by --plan-out renames files with --plan-in """
+    monkeypatch.setattr("builtins.input", lambda *args: "Y")
+    os.chdir(param_fs)
+    args = parser.parse_args(["--plan-out", "plan.jsonl", "-q"])
+    renamer.finish_rename(src, dest, args)
+    for s in src:
+        assert (param_fs / s).read_text() == s
+
+    src_files, dest_files = plan.read_plan("plan.jsonl")
+    assert list(zip(src_files, dest_files)) == list(zip(src, dest))[:3]
+    with open("plan.jsonl") as f:
+        assert sum('"type": "conflict"' in line for line in f) == 2
+
+    args = parser.parse_args(["--plan-in", "plan.jsonl", "-q"])
+    renamer.finish_rename(src_files, dest_files, args)
+    for s, d in list(zip(src, dest))[:3]:
+        assert (param_fs / d).read_text() == s
+    assert (param_fs / "dir2/01").read_text() == "dir2/01"
+
+
+def set_old(path):
+    """Move modification time of path out of the racy window """
+    old = int(time.time() * 10**9) - 10 * cache.RACY_NS
+    os.utime(path, ns=(old, old))
+
+
+def test_cache_listing(monkeypatch, tmp_path):
+    """Test that listings of unchanged directories are read from the cache """
+    for d in ("a", "b"):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / "f1").write_text("")
+        set_old(tmp_path / d)
+    os.chdir(tmp_path)
+    reads = []
+    readdir = scanner._readdir
+    monkeypatch.setattr(scanner, "_readdir", lambda d: reads.append(d) or readdir(d))
+
+    store = cache.PlanCache.load("plans.json")
+    files = bren.glob_files("*/*", cache=scanner.DirCache(store))
+    store.save()
+    assert files == ["a/f1", "b/f1"]
+    assert sorted(reads) == ["", "a", "b"]
+
+    (tmp_path / "b" / "f2").write_text("")
+    set_old(tmp_path / "b")
+    reads.clear()
+    store = cache.PlanCache.load("plans.json")
+    files = bren.glob_files("*/*", cache=scanner.DirCache(store))
+    assert files == ["a/f1", "b/f1", "b/f2"]
+    assert sorted(reads) == ["", "b"]
+
+
+def test_cache_shared(tmp_path):
+    """Test that runs in different directories don't share entries,
+    even if the directories have the same modification time """
+    for d, name in (("p", "one.txt"), ("q", "two.txt")):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / name).write_text("")
+        set_old(tmp_path / d)
+    st = os.stat(str(tmp_path / "p"))
+    os.utime(str(tmp_path / "q"), ns=(st.st_atime_ns, st.st_mtime_ns))
+    plans = str(tmp_path / "plans.json")
+
+    args = parser.parse_args(["-c", "upper"])
+    for d, name in (("p", "one.txt"), ("q", "two.txt"), ("p", "one.txt")):
+        os.chdir(str(tmp_path / d))
+        store = cache.PlanCache.load(plans)
+        files = bren.glob_files("*", cache=scanner.DirCache(store))
+        assert files == [name]
+        dests = store.renames(files, store.signature(args), lambda f: [x.upper() for x in f])
+        assert dests == [name.upper()]
+        store.save()
+    assert store.hits == 1
+    assert sorted(store.dirs) == [str(tmp_path / "p"), str(tmp_path / "q")]
+
+
+def test_cache_racy(tmp_path):
+    """Test that recently changed directories are not stored """
+    (tmp_path / "f1").write_text("")
+    store = cache.PlanCache()
+    entries = store.scandir(str(tmp_path), scanner._readdir)
+    assert [e.name for e in entries] == ["f1"]
+    assert not store.dirs
+
+
+@pytest.mark.parametrize("ren_arg", [
+    ["-seq", "%f/_/%n", "-c", "upper"],
+    ["-bracr", "r", "-sp", "."],
+])
+def test_cache_renames(tmp_path, ren_arg):
+    """Test that dests are only computed for changed directories """
+    src = ["{}/file {}.txt".format(d, n) for d in ("a", "b", "c") for n in range(5)]
+    for d in ("a", "b", "c"):
+        (tmp_path / d).mkdir()
+    for f in src:
+        (tmp_path / f).write_text("")
+    for d in ("a", "b", "c"):
+        set_old(tmp_path / d)
+    os.chdir(tmp_path)
+
+    args = parser.parse_args(ren_arg)
+    filters = renamer.initfilters(args)
+    expected = renamer.get_renames(src, filters, args.extension, args.raw)
+    calls = []
+
+    def get_renames(files):
+        calls.append(files)
+        return renamer.get_renames(files, renamer.initfilters(args), args.extension, args.raw)
+
+    store = cache.PlanCache("plans.json")
+    sig = store.signature(args)
+    dirs = scanner.DirCache(store)
+    for d in ("a", "b", "c"):
+        dirs.scandir(d)
+    assert store.renames(src, sig, get_renames) == expected
+    store.save()
+
+    (tmp_path / "b" / "new").write_text("")
+    set_old(tmp_path / "b")
+    calls.clear()
+    store = cache.PlanCache.load("plans.json")
+    assert store.renames(src, sig, get_renames) == expected
+    assert calls == [src[5:10]]
+    assert store.hits == 2
+
+    # other renaming arguments don't reuse dests
+    calls.clear()
+    other = store.signature(parser.parse_args(ren_arg + ["-pre", "x"]))
+    store.renames(src, other, get_renames)
+    assert calls == [src]
+
+
+def test_cache_signature():
+    """Test which arguments change the cache signature """
+    store = cache.PlanCache()
+    sig = store.signature(parser.parse_args(["dir", "-sp"]))
+    assert sig == store.signature(parser.parse_args(["other", "-sp", "-v", "--dryrun"]))
+    assert sig != store.signature(parser.parse_args(["dir", "-sp", "-c", "lower"]))
+    assert store.signature(parser.parse_args(["-seq", "%f/_/%md"])) is None
+
+    # long patterns are cut short in the repr of a compiled regex
+    long_a = store.signature(parser.parse_args(["-re", "x" * 250 + "A"]))
+    long_b = store.signature(parser.parse_args(["-re", "x" * 250 + "B"]))
+    assert long_a != long_b
+    assert long_a == store.signature(parser.parse_args(["-re", "x" * 250 + "A"]))
+    assert store.signature(parser.parse_args(["-re", "a", "b", "1"])) != \
+        store.signature(parser.parse_args(["-re", "a", "b", "2"]))
+    assert store.signature(parser.parse_args(["-sl", "1:3"])) != \
+        store.signature(parser.parse_args(["-sl", "1:4"]))
+
+
+def test_cache_size(tmp_path):
+    """Test that the least recently used directories are dropped """
+    store = cache.PlanCache(str(tmp_path / "plans.json"), size=5)
+    for d in ("a", "b", "c"):
+        (tmp_path / d).mkdir()
+        for n in range(2):
+            (tmp_path / d / str(n)).write_text("")
+        set_old(tmp_path / d)
+        store.scandir(str(tmp_path / d), scanner._readdir)
+    store.scandir(str(tmp_path / "a"), scanner._readdir)
+    store.save()
+    store = cache.PlanCache.load(str(tmp_path / "plans.json"))
+    assert list(store.dirs) == [str(tmp_path / "c"), str(tmp_path / "a")]
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+import os
+import random
+import re
+from functools import partial
+
+import pytest
+
+from batchren import bren, renamer
+from batchren.tui import arrange_tui, preview, selection_tui
+
+"""Tests for batchren.tui written with pytest.
+
+Performs tests for the following:
+- selection bitset
+- lazily built file list
+- search index and filtered file list
+- file arrangement and reordering
+- rename preview
+
+Widgets are rendered to a canvas and driven with keypresses,
+no terminal is needed.
+"""
+
+SIZE = (80, 10)
+
+
+@pytest.mark.parametrize("default", [False, True])
+def test_selection(default):
+    """Test that the bitset keeps states apart from its default """
+    sel = selection_tui.Selection(21, default)
+    assert len(sel) == 21
+    assert [sel[n] for n in range(21)] == [default] * 21
+    for n in (0, 7, 8, 20):
+        sel[n] = not default
+    sel[7] = default
+    assert [n for n in range(21) if sel[n] != default] == [0, 8, 20]
+
+    sel.set_all(not default)
+    assert all(sel[n] == (not default) for n in range(21))
+
+
+def test_filelist_lazy():
+    """Test that only shown rows have widgets """
+    files = ["file{}".format(n) for n in range(100000)]
+    box = selection_tui.FileListBox(files)
+    box.render(SIZE, focus=True)
+    assert len(box.body.widgets) <= SIZE[1] + 1
+
+    box.keypress(SIZE, "end")
+    box.render(SIZE, focus=True)
+    assert box.focus_position == len(files) - 1
+    assert len(box.body.widgets) <= box.body.cache_size
+
+
+def test_filelist_select():
+    """Test that selections survive widgets being dropped """
+    files = ["file{}".format(n) for n in range(1000)]
+    box = selection_tui.FileListBox(files)
+    box.body.cache_size = 12
+    box.render(SIZE, focus=True)
+    box.keypress(SIZE, "down")
+    box.keypress(SIZE, " ")
+    box.keypress(SIZE, "end")
+    box.render(SIZE, focus=True)
+    box.keypress(SIZE, " ")
+    box.keypress(SIZE, "home")
+    box.render(SIZE, focus=True)
+    assert box.body[1].base_widget.state
+    assert box.get_selected() == ["file1", "file999"]
+
+    box.toggle_all(True)
+    box.render(SIZE, focus=True)
+    assert box.focus_position == 0
+    assert box.body[5].base_widget.state
+    assert len(box.get_selected()) == len(files)
+    box.keypress(SIZE, " ")
+    box.toggle_all(False)
+    assert box.get_selected() == []
+
+
+FILES = ["src/Main.py", "src/util.py", "docs/readme.md", "docs/Guide.MD", "setup.py"]
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("", None),
+    ("py", [0, 1, 4]),
+    ("MAIN", [0]),
+    ("*.md", [2, 3]),
+    ("docs/*", [2, 3]),
+    ("s?tup*", [4]),
+    ("src/*", [0, 1]),
+    ("*UTIL*", [1]),
+    ("[mu]*.py", []),
+    ("*/[mu]*.py", [0, 1]),
+    ("re:^src/", [0, 1]),
+    ("re:\\.md$", [2, 3]),
+    ("re:Guide", [3]),
+])
+def test_index_search(query, expected):
+    """Test substring, glob and regex queries """
+    index = selection_tui.FileIndex(FILES)
+    assert index.search(query) == expected
+
+
+def test_index_incremental():
+    """Test that narrowing a query gives the same matches as a new search """
+    files = ["dir{}/file{}.txt".format(n % 7, n) for n in range(2000)]
+    index = selection_tui.FileIndex(files)
+    for query in ("d", "di", "dir3", "dir3/", "dir3/file1", "dir", "*1.txt", "file", "file2"):
+        assert index.search(query) == selection_tui.FileIndex(files).search(query)
+    with pytest.raises(re.error):
+        index.search("re:(")
+
+
+def keypress(tui, key):
+    if tui.view.keypress(SIZE, key) is not None:
+        tui.unhandled_input(key)
+
+
+def test_selector_search():
+    """Test that search narrows the list and select all only selects matches """
+    tui = selection_tui.FileSelector(FILES)
+    tui.view.render(SIZE, focus=True)
+    for key in "/*.md":
+        keypress(tui, key)
+    assert len(tui.body.body) == 2
+    assert tui.status_line.text == "2 of 5 files match"
+    keypress(tui, "enter")
+    assert tui.view.focus_position == "body"
+    keypress(tui, "a")
+    tui.view.render(SIZE, focus=True)
+    assert tui.body.get_selected() == ["docs/readme.md", "docs/Guide.MD"]
+
+    keypress(tui, "esc")
+    assert len(tui.body.body) == len(FILES)
+    for key in "/re:^s":
+        keypress(tui, key)
+    assert len(tui.body.body) == 3
+    keypress(tui, "(")
+    assert len(tui.body.body) == 3
+    assert tui.status_line.text.startswith("invalid regex")
+    keypress(tui, "esc")
+    assert tui.view.focus_position == "body"
+    assert len(tui.body.body) == len(FILES)
+    tui.view.render(SIZE, focus=True)
+    assert tui.body.body[3].base_widget.state
+    assert not tui.body.body[0].base_widget.state
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_arrangement(seed):
+    """Test that moves and sorts match the same operations on a list """
+    rand = random.Random(seed)
+    n = rand.randint(1, 60)
+    arrangement = arrange_tui.Arrangement(range(n))
+    expected = list(range(n))
+    history = [list(expected)]
+    for _ in range(100):
+        start = rand.randrange(n)
+        stop = rand.randint(start + 1, n)
+        dest = rand.randint(0, n - stop + start)
+        block = expected[start:stop]
+        del expected[start:stop]
+        expected[dest:dest] = block
+        arrangement.move(start, stop, dest)
+        if history[-1] != expected:
+            history.append(list(expected))
+        if rand.random() < 0.2:
+            start = rand.randrange(n)
+            stop = rand.randint(start, n)
+            expected[start:stop] = sorted(expected[start:stop], key=lambda x: x % 5, reverse=True)
+            arrangement.sort(start, stop, key=lambda x: x % 5, reverse=True)
+        assert list(arrangement) == expected
+        if history[-1] != expected:
+            history.append(list(expected))
+    assert [arrangement[i] for i in range(n)] == expected
+    with pytest.raises(IndexError):
+        arrangement[n]
+    with pytest.raises(IndexError):
+        arrangement.move(0, 1, n)
+
+    for state in reversed(history[:-1]):
+        assert arrangement.undo() is not None
+        assert list(arrangement) == state
+    assert arrangement.undo() is None
+    for state in history[1:]:
+        assert arrangement.redo() is not None
+        assert list(arrangement) == state
+    assert arrangement.redo() is None
+    assert arrangement.reset() == (len(history) > 1)
+    assert list(arrangement) == list(range(n))
+
+
+def test_arrange_lazy():
+    """Test that only shown rows of a large directory have widgets """
+    files = ["dir/file{}".format(n) for n in range(100000)]
+    tui = arrange_tui.FileArranger(files)
+    tui.view.render(SIZE, focus=True)
+    box = tui.body.body[1].base_widget
+    assert len(box.body.widgets) <= arrange_tui.MAX_ROWS + 1
+    assert tui.body.get_output() == files
+
+
+def test_arrange_move(tmp_path):
+    """Test that picked files and ranges are dropped at the focus """
+    files = [str(tmp_path / "file{}".format(n)) for n in range(10)]
+    for n, f in enumerate(files):
+        with open(f, "w") as out:
+            out.write("x" * (n % 3))
+    tui = arrange_tui.FileArranger(files)
+    tui.view.render(SIZE, focus=True)
+    for key in ["enter", "enter", "down", "down", "enter"]:
+        keypress(tui, key)
+    names = [os.path.basename(f) for f in tui.body.get_output()]
+    assert names[:4] == ["file1", "file2", "file0", "file3"]
+
+    # move a range of three files to the end
+    for key in ["home", " ", "down", "down", "enter", "end", "enter"]:
+        keypress(tui, key)
+    names = [os.path.basename(f) for f in tui.body.get_output()]
+    assert names == ["file3", "file4", "file5", "file6", "file7", "file8",
+                     "file9", "file1", "file2", "file0"]
+
+    keypress(tui, "n")
+    assert tui.body.get_output() == files
+    keypress(tui, "n")
+    assert tui.body.get_output() == files[::-1]
+    keypress(tui, "s")
+    sizes = [os.path.getsize(f) for f in tui.body.get_output()]
+    assert sizes == sorted(sizes)
+
+    keypress(tui, "u")
+    assert tui.body.get_output() == files[::-1]
+    keypress(tui, "u")
+    assert tui.body.get_output() == files
+    keypress(tui, "ctrl r")
+    assert tui.body.get_output() == files[::-1]
+
+    keypress(tui, "r")
+    assert tui.body.get_output() == files
+    assert not tui.body.toggle
+    keypress(tui, "enter")
+    keypress(tui, "ctrl r")
+    assert tui.body.get_output()[0] == files[1]
+
+
+def full_plan(files, filters):
+    """Return {src: (dest, issue codes)} of a plan made for every file at once """
+    dests = renamer.get_renames(files, filters, None, False)
+    rentable = renamer.generate_rentable(files, dests)
+    errors = {}
+    for obj in rentable["conflicts"].values():
+        for src in obj["srcs"]:
+            errors.setdefault(src, set()).update(obj["err"])
+    return {src: (dest, errors.get(src, set())) for src, dest in zip(files, dests)}
+
+
+@pytest.fixture
+def preview_files(tmp_path):
+    # directories a and b alternate, so each has several runs
+    files = []
+    for n in range(12):
+        dirpath = tmp_path / ("a" if n % 5 < 3 else "b")
+        dirpath.mkdir(exist_ok=True)
+        path = dirpath / "{}.txt".format(n)
+        path.touch()
+        files.append(str(path))
+    return files
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_preview_include(preview_files, seed):
+    """Test that including and excluding files matches a full plan """
+    args = bren.parser.parse_args(["-seq", "%n1:1:3"])
+    filters = renamer.initfilters(args)
+    planner = preview.PreviewPlanner(preview_files, filters, included=False)
+    included = [False] * len(preview_files)
+    rand = random.Random(seed)
+    for step in range(40):
+        if step == 20:
+            state = rand.random() < 0.5
+            planner.include_all(state)
+            included = [state] * len(preview_files)
+        n = rand.randrange(len(preview_files))
+        included[n] = not included[n]
+        planner.include(n, included[n])
+
+        files = [f for f, inc in zip(preview_files, included) if inc]
+        expected = full_plan(files, filters)
+        for n, f in enumerate(preview_files):
+            assert planner.preview(n) == expected.get(f)
+
+
+def test_preview_reorder(tmp_path):
+    """Test that reordering a directory only plans that directory again """
+    files = []
+    for dirname in ("a", "b"):
+        (tmp_path / dirname).mkdir()
+        for name in ("1.txt", "x.txt", "y.txt", "z.txt"):
+            (tmp_path / dirname / name).touch()
+            files.append(str(tmp_path / dirname / name))
+    args = bren.parser.parse_args(["-seq", "%n1:1:3"])
+    planner = preview.PreviewPlanner(files, renamer.initfilters(args))
+    assert [os.path.basename(planner.preview(n)[0]) for n in range(4)] == \
+        ["1.txt", "2.txt", "3.txt", "1.txt"]
+    assert planner.preview(0)[1] == {0, 6}
+    planner.preview(4)
+
+    planner.reorder(str(tmp_path / "a"), [1, 2, 3, 0])
+    assert planner.dirty == {str(tmp_path / "a")}
+    assert [os.path.basename(planner.preview(n)[0]) for n in (1, 2, 3, 0)] == \
+        ["1.txt", "2.txt", "3.txt", "1.txt"]
+    # x.txt shares 1.txt with the file already named 1.txt
+    assert planner.preview(1)[1] == {0, 6}
+    assert planner.preview(2)[1] == set()
+    assert preview.preview_markup(planner, 2) == ("preview ok", "2.txt")
+
+
+def test_preview_tui(preview_files):
+    """Test that the previews follow selection and reordering """
+    args = bren.parser.parse_args(["-seq", "%n"])
+    plan = partial(preview.PreviewPlanner, filters=renamer.initfilters(args))
+
+    tui = selection_tui.FileSelector(preview_files, plan)
+    tui.view.render(SIZE, focus=True)
+    walker = tui.body.body
+    assert walker[0].base_widget.contents[1][0].text == ""
+    keypress(tui, "down")
+    keypress(tui, " ")
+    tui.view.render(SIZE, focus=True)
+    assert walker[1].base_widget.contents[1][0].text == "01.txt"
+    keypress(tui, "up")
+    keypress(tui, " ")
+    tui.view.render(SIZE, focus=True)
+    assert walker[1].base_widget.contents[1][0].text == "02.txt"
+
+    tui = arrange_tui.FileArranger(preview_files, preview=plan)
+    tui.view.render(SIZE, focus=True)
+    box = tui.body.body[1].base_widget
+    assert box.body[0].base_widget.contents[1][0].text == "01.txt"
+    for key in ["enter", "enter", "down", "enter"]:
+        keypress(tui, key)
+    tui.view.render(SIZE, focus=True)
+    assert box.body[0].base_widget.contents[0][0].base_widget.text == "1.txt"
+    assert box.body[0].base_widget.contents[1][0].text == "01.txt"
+    assert box.body[1].base_widget.contents[1][0].text == "02.txt"